@@ -11,6 +11,9 @@ your username and password out of the shell history and uses an exclude file.
 In practice, one might have complex needs.
 For example, the website may be built from assets in multiple, separately managed directory trees on the local host.
 Using sftpclone programmatically with exclude files makes it easy to script one-step deployments for such situations.
+
+Each deployment goes to a new release directory, switched to at once when complete:
+the web server's document root should be the `current` symbolic link (here, ./mysite/current).
 """
 
 import getpass
@@ -32,10 +35,12 @@ def deploy_assets(username, password):
     # The local path and the remote path in this function should
     # correspond to where you build the static site locally and where
     # it should go on the remote sftp server.
+    # The last 5 releases are kept, to roll back to.
     sftpclone.SFTPClone(
         './build',
         "{}:{}@mysite.example.com:./mysite".format(username, password),
-        exclude_file='exclude.txt'
+        exclude_file='exclude.txt',
+        releases=5,
     ).run()
 
 
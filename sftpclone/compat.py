@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Python 2.7 backward compatibility."""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import sys
+
+try:
+    # file names are sent as the very bytes they are on disk, even if they aren't valid UTF-8,
+    # and those read from the server are decoded as the local ones are (with surrogate escapes)
+    from os import fsencode, fsdecode
+except ImportError:  # Python 2.x
+    _FS_ENCODING = sys.getfilesystemencoding() or "utf-8"
+
+    def fsencode(path):
+        """Encode path with the file system encoding, if it's text."""
+        return path if isinstance(path, bytes) else path.encode(_FS_ENCODING)
+
+    def fsdecode(path):
+        """Decode path with the file system encoding, if it's bytes.
+
+        Without surrogate escapes, names which can't be decoded stay bytes, as `os.listdir` leaves them."""
+        if isinstance(path, bytes):
+            try:
+                return path.decode(_FS_ENCODING)
+            except UnicodeDecodeError:
+                pass
+        return path
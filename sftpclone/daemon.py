@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Keep SSH connections open and run sync jobs submitted through a Unix socket."""
+
+# Python 2.7 backward compatibility
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+try:
+    import socketserver
+except ImportError:  # Python 2.x
+    import SocketServer as socketserver
+
+from sftpclone import sftpclone
+from sftpclone.sftpclone import SFTPClone, parse_username_password_hostname
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def connection_key(options):
+    """Return what identifies the SSH connection needed by a job."""
+    username, password, hostname, _ = parse_username_password_hostname(options["remote_url"])
+    return json.dumps([
+        username, password, hostname, options.get("port"),
+        options.get("ssh_config_path"), options.get("identity_files"),
+        options.get("ssh_agent"), options.get("known_hosts_path"),
+    ])
+
+
+class _JobLogHandler(logging.Handler):
+
+    """Send to the client the records logged by the thread running its job.
+
+    Threads started by the job are named after it (`<job thread name>-...`)."""
+
+    def __init__(self, send, level):
+        logging.Handler.__init__(self, level)
+        self.send = send
+        self.thread_name = threading.current_thread().name
+        self.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    def emit(self, record):
+        if record.threadName != self.thread_name and \
+                not record.threadName.startswith(self.thread_name + "-"):
+            return
+        try:
+            self.send({"log": self.format(record)})
+        except (IOError, OSError):
+            pass  # the client went away, the job goes on
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+
+    """Read a job from the client, run it, stream back its log and its exit status."""
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode("utf-8"))
+        except ValueError:
+            return
+
+        log_handler = _JobLogHandler(self.send, job.get("logging", logging.ERROR))
+        self.server.logger.addHandler(log_handler)
+        try:
+            status = self.server.run_job(job["options"])
+        finally:
+            self.server.logger.removeHandler(log_handler)
+
+        try:
+            self.send({"status": status})
+        except (IOError, OSError):
+            pass
+
+
+class SyncDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """Run sync jobs on authenticated SSH transports, kept open between jobs (one per host)."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, logger=None):
+        """Listen for jobs on the Unix socket at socket_path."""
+        self.socket_path = socket_path
+        self.logger = logger or logging.getLogger(sftpclone.__name__)
+
+        self._transports = {}  # connection key -> transport
+        self._credentials = {}  # connection key -> what's needed to open more (see `SFTPClone.credentials`)
+        self._locks = {}  # connection key -> lock
+        self._lock = threading.Lock()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # left behind by a previous daemon
+
+        # only the owner can submit jobs (the socket gives access to its credentials)
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _JobHandler)
+        finally:
+            os.umask(umask)
+
+    def _connection_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _keep_transport(self, key, transport):
+        """Keep the transport a job ended with, if it's been opened again meanwhile (see `SFTPClone._reconnect`).
+
+        It replaces the kept one if that one has been lost, otherwise it's closed."""
+        with self._connection_lock(key):
+            kept = self._transports.get(key)
+            if transport is kept:
+                return
+            if kept is not None and kept.is_active():  # e.g. opened again by another job
+                transport.close()
+                return
+            self._transports[key] = transport
+        if kept is not None:
+            kept.close()
+
+    def run_job(self, options):
+        """Run a sync job, described by the keyword arguments of `SFTPClone`.
+
+        Jobs can open more connections, and open them again if lost, like the first one.
+        They can't fork upload processes: the daemon's other threads would be missing in them.
+
+        :return: The job exit status.
+        """
+        if (options.get("processes") or 1) > 1:
+            self.logger.error("Upload processes can't be forked by the daemon.")
+            return 2
+
+        try:
+            key = connection_key(options)
+            with self._connection_lock(key):
+                transport = self._transports.get(key)
+                if transport is not None and not transport.is_active():
+                    transport = None
+
+                sync = SFTPClone(transport=transport, credentials=self._credentials.get(key), **options)
+                self._transports[key] = sync.transport
+                self._credentials[key] = sync.credentials
+
+            try:
+                sync.run()
+            finally:
+                sync.close(transport=False)
+                self._keep_transport(key, sync.transport)
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            self.logger.exception("Error while syncing: {}".format(e))
+            return 1
+
+        return 0
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        for transport in self._transports.values():
+            transport.close()
+        for credentials in self._credentials.values():
+            agent = credentials[3] if credentials else None
+            if agent is not None:
+                agent.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def serve(socket_path, log_level=logging.ERROR):
+    """Run a sync daemon on socket_path, until interrupted."""
+    # jobs choose their own log level
+    logger = logging.getLogger(sftpclone.__name__)
+    logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler()
+    handler.setLevel(log_level)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
+    sftpclone.logger = logger
+
+    daemon = SyncDaemon(socket_path, logger)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
+def submit_job(socket_path, options, log_level=logging.ERROR):
+    """Submit a sync job to the daemon listening at socket_path and print its log.
+
+    :return: The job exit status.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        stream = sock.makefile("rwb")
+        stream.write(json.dumps({"options": options, "logging": log_level}).encode("utf-8") + b"\n")
+        stream.flush()
+
+        for line in stream:
+            message = json.loads(line.decode("utf-8"))
+            if "log" in message:
+                print(message["log"], file=sys.stderr)
+            elif "status" in message:
+                return message["status"]
+    finally:
+        sock.close()
+
+    # the daemon went away without telling us how it went
+    return 1
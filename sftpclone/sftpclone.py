@@ -8,16 +8,37 @@ from __future__ import absolute_import
 
 import paramiko
 import paramiko.py3compat
+from paramiko.sftp import CMD_CLOSE, CMD_EXTENDED, CMD_HANDLE, CMD_NAME, CMD_OPENDIR, CMD_READDIR, \
+    CMD_SETSTAT, CMD_STATUS, CMD_VERSION, SFTPError
 import os
 import os.path
 import sys
-import errno
 from stat import S_ISDIR, S_ISLNK, S_ISREG, S_IMODE, S_IFMT
 import argparse
+import binascii
+import errno
+import functools
 import logging
 from getpass import getuser, getpass
 import glob
 import socket
+import hashlib
+import io
+import json
+import mmap
+import re
+import subprocess
+import threading
+import time
+from collections import Counter, deque, namedtuple
+
+from sftpclone.compat import fsencode, fsdecode
+from sftpclone.watch import create_watcher, watch_changes
+
+try:
+    from shlex import quote
+except ImportError:  # Python 2.x
+    from pipes import quote
 
 """SFTPClone: sync local and remote directories."""
 
@@ -29,6 +50,117 @@ try:
 except NameError:
     FileNotFoundError = IOError
 
+# smaller files aren't worth hashing, a server-side copy costs more than uploading them
+DEDUPE_MIN_SIZE = 32 * 1024
+
+# SFTP channels uploading files at the same time
+DEFAULT_CHANNELS = 4
+DEFAULT_CONNECTIONS = 1
+# SFTP channels listing remote directories at the same time
+DEFAULT_SCAN_CHANNELS = 4
+# READDIR requests kept in flight while a remote directory is streamed
+DEFAULT_LISTING_REQUESTS = 50
+# operations interrupted by a lost connection are retried, after reconnecting,
+# waiting twice as long each time (seconds)
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 1.0
+# at most, between the attempts of the watch mode to sync the changes again
+MAX_RETRY_DELAY = 60.0
+DEFAULT_PROCESSES = 1
+# files this large get a channel of their own, smaller ones are uploaded in batches
+LARGE_FILE_SIZE = 8 * 1024 * 1024
+SMALL_FILES_BATCH = 64
+# files larger than this are split into chunks, written at the same time by several channels
+CHUNKED_FILE_SIZE = 64 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024 * 1024
+# files are sent in blocks of about this size (whole write requests),
+# larger ones straight from a memory map of theirs
+UPLOAD_BLOCK_SIZE = 256 * 1024
+MMAP_MIN_SIZE = 1024 * 1024
+# threads reading ahead the files about to be uploaded
+READ_AHEAD_THREADS = 4
+# local directories listed ahead of the comparison, at most
+LOCAL_SCAN_AHEAD = 1024
+# the adaptive mode uses up to this many channels (or --channels, if more)
+ADAPTIVE_MAX_CHANNELS = 16
+ADAPTIVE_STATS = ("channels", "pipeline depth", "rtt ms")
+# bounds of the write requests in flight on each channel
+MIN_PIPELINE_DEPTH = 4
+MAX_PIPELINE_DEPTH = 100
+# the chunks are checked by hashing blocks of this size on the server (`check-file` extension)
+VERIFY_BLOCK_SIZE = 64 * 1024
+# seconds to wait for the exit status of the command probing exec
+EXEC_PROBE_TIMEOUT = 10
+# a remote `cp` taking longer is given up (and the file uploaded instead)
+REMOTE_CP_TIMEOUT = 300
+# the last deployed commit, in the remote directory, for the git mode (see `SFTPClone.git_plan`)
+GIT_STATE_FILE = ".sftpclone-git.json"
+# layout of the release deployments: releases/<UTC timestamp>/, and the current symlink to one of them
+RELEASES_DIR = "releases"
+CURRENT_LINK = "current"
+RELEASE_NAME_FORMAT = "%Y%m%d%H%M%S"
+# hard links in flight, while a new release is seeded with the unchanged files of the previous one
+SEED_REQUESTS = 64
+
+# Kinds of the actions of a sync plan
+DELETE = "delete"
+MKDIR = "mkdir"
+UPLOAD = "upload"
+LINK = "link"
+COPY = "copy"
+SYMLINK = "symlink"
+SETSTAT = "setstat"
+
+
+class Stat(object):
+
+    """The attributes of a node that a sync plan needs, with the names of those of os.stat_result.
+
+    Plans of huge trees hold one per action: this record takes a fraction of the memory of
+    an os.stat_result or a paramiko.SFTPAttributes, and the values repeated all over a tree
+    (modes and owners) are shared."""
+
+    __slots__ = ("st_mode", "st_size", "st_uid", "st_gid", "st_atime", "st_mtime")
+
+    _shared = {}
+
+    def __init__(self, st_mode=None, st_size=None, st_uid=None, st_gid=None, st_atime=None, st_mtime=None):
+        shared = self._shared.setdefault
+        self.st_mode = shared(st_mode, st_mode)
+        self.st_size = st_size
+        self.st_uid = shared(st_uid, st_uid)
+        self.st_gid = shared(st_gid, st_gid)
+        self.st_atime = st_atime
+        self.st_mtime = st_mtime
+
+    @classmethod
+    def from_stat(cls, st):
+        """Return the record of the attributes of an os.stat_result, or a paramiko.SFTPAttributes."""
+        return cls(st.st_mode, st.st_size, st.st_uid, st.st_gid, st.st_atime, st.st_mtime)
+
+    def __repr__(self):
+        return "Stat({})".format(", ".join("{}={!r}".format(k, getattr(self, k)) for k in self.__slots__))
+
+
+class Action(namedtuple("Action", ["kind", "path", "size", "st", "source"])):
+
+    """A step of a sync plan: its kind, the path relative to the shared directory,
+    the bytes to upload, the local stat (remote attributes, for deletions) and
+    the destination of symlinks or the relative path of the file to link/copy.
+
+    The stat is kept as a `Stat`."""
+
+    __slots__ = ()
+
+    def __new__(cls, kind, path, size, st, source):
+        if st is not None and type(st) is not Stat:
+            st = Stat.from_stat(st)
+        return super(Action, cls).__new__(cls, kind, path, size, st, source)
+
+
+# A byte range of the file uploaded by an upload action
+Chunk = namedtuple("Chunk", ["action", "offset", "length"])
+
 
 def configure_logging(level=logging.DEBUG):
     """Configure the module logging engine."""
@@ -53,10 +185,710 @@ def configure_logging(level=logging.DEBUG):
 def path_join(*args):
     """
     Wrapper around `os.path.join`.
-    Makes sure to join paths of the same type (bytes).
+    Makes sure to join paths of the same type (text): bytes are decoded as file names are (see `fsdecode`).
+    On Python 2.x, the names which can't be decoded are joined as bytes.
+    """
+    try:
+        path = os.path.join(*args)
+    except (TypeError, UnicodeDecodeError):  # some of them are bytes
+        args = [fsdecode(arg) for arg in args]
+        if any(isinstance(arg, bytes) for arg in args):
+            args = [fsencode(arg) for arg in args]
+        return os.path.join(*args)
+    return fsdecode(path) if isinstance(path, bytes) else path
+
+
+def printable(path):
+    """Return path as it can be printed, with the bytes that aren't valid UTF-8 escaped."""
+    path = fsencode(path)
+    try:
+        return path.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # like the "backslashreplace" error handler, which Python 2.x can't decode with
+        return path[:e.start].decode("utf-8") + \
+            "".join("\\x{:02x}".format(b) for b in bytearray(path[e.start:e.end])) + printable(path[e.end:])
+
+
+def file_digest(path, block_size=1024 * 1024):
+    """Return the SHA-256 digest of the content of the file at path."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.digest()
+
+
+def is_sparse(fd):
+    """Tell whether the open file fd has holes (fewer blocks allocated than its size needs)."""
+    st = os.fstat(fd)
+    return getattr(st, "st_blocks", None) is not None and st.st_blocks * 512 < st.st_size
+
+
+def data_extents(fd, start, end):
+    """Return the (offset, length) of the data regions of the open file fd, between start and end.
+
+    Holes are found with SEEK_DATA and SEEK_HOLE: where they aren't supported, it's all data."""
+    if not hasattr(os, "SEEK_DATA"):  # Python < 3.3, or not supported by the OS
+        return [(start, end - start)]
+
+    extents = []
+    offset = start
+    try:
+        while offset < end:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # nothing but a hole up to the end
+                    break
+                raise
+            if data >= end:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+            extents.append((data, hole - data))
+            offset = hole
+    except OSError:  # e.g. not supported by the file system
+        return [(start, end - start)]
+    return extents
+
+
+def shard_by_size(actions, n):
+    """Split actions into up to n shards of about the same total size.
+
+    The largest ones are placed first, each one into the smallest shard so far."""
+    shards = [[] for _ in range(n)]
+    sizes = [0] * n
+    for action in sorted(actions, key=lambda a: a.size, reverse=True):
+        i = sizes.index(min(sizes))
+        shards[i].append(action)
+        sizes[i] += action.size
+    return [shard for shard in shards if shard]
+
+
+def git_output(path, *args):
+    """Run git with args in the directory at path and return its output.
+
+    Raise OSError if git can't be run, or CalledProcessError if it fails (e.g. not a repository)."""
+    with open(os.devnull, 'wb') as devnull:
+        out = subprocess.check_output(("git",) + args, cwd=path, stderr=devnull)
+    return fsdecode(out)
+
+
+def parse_name_status(output):
+    """Return the set of paths changed, added, deleted, or renamed (both names) in a `git diff --name-status -z`."""
+    fields = iter(output.split("\0"))
+    paths = set()
+    for status in fields:
+        if not status:
+            continue
+        paths.add(next(fields))
+        if status[0] in "RC":  # renamed or copied, then the new name
+            paths.add(next(fields))
+    return paths
+
+
+def parse_path_list(content):
+    """Return the relative paths listed in content, one per line or NUL-separated.
+
+    Leading slashes and `./` are dropped, paths leading out of the tree raise ValueError."""
+    paths = []
+    nul = "\0" in content
+    for line in content.split("\0" if nul else "\n"):
+        if not nul:
+            line = line.rstrip("\r")
+        if not line:
+            continue
+        path = os.path.normpath(line.lstrip("/"))
+        if path == os.curdir:
+            continue
+        if path == os.pardir or path.startswith(os.pardir + os.sep):
+            raise ValueError("{} is outside the local folder".format(line))
+        paths.append(path)
+    return paths
+
+
+def parse_size(size):
+    """Parse a size in bytes, with an optional K, M or G (powers of 1024) suffix."""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$", size, re.IGNORECASE)
+    if not match:
+        raise ValueError("invalid size: '{}'".format(size))
+
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** "_KMG".index(unit.upper() or "_"))
+
+
+def parse_bwlimit(bwlimit):
     """
-    args = (paramiko.py3compat.u(arg) for arg in args)
-    return os.path.join(*args)
+    Parse a bandwidth limit, optionally changing with the time of the day.
+
+    It is a comma separated list of rates (in bytes/sec).
+    Each rate applies to a time window (e.g. `08:00-18:30=512K`),
+    or it is the default (e.g. `4M`). A rate of 0 means no limit.
+
+    :param bwlimit: A bandwidth limit string.
+    :return: A tuple, containing the default rate and a list of (start minute, end minute, rate) windows.
+    """
+    rate, schedule = 0, []
+    for item in str(bwlimit).split(","):
+        if "=" not in item:
+            rate = parse_size(item)
+            continue
+
+        window, window_rate = item.split("=", 1)
+        match = re.match(r"^\s*(\d\d?):(\d\d)\s*-\s*(\d\d?):(\d\d)\s*$", window)
+        if not match:
+            raise ValueError("invalid time window: '{}'".format(window))
+
+        start_h, start_m, end_h, end_m = (int(g) for g in match.groups())
+        schedule.append((start_h * 60 + start_m, end_h * 60 + end_m, parse_size(window_rate)))
+
+    return rate, schedule
+
+
+class TokenBucket(object):
+
+    """Keep the average rate of a flow of bytes under a limit, letting short bursts through.
+
+    It is shared by all the concurrent transfers."""
+
+    def __init__(self, rate, schedule=None, burst=1.0):
+        """Allow rate bytes/sec (0 for no limit), changing according to schedule (see `parse_bwlimit`).
+
+        Bursts can last up to burst seconds at full speed."""
+        self.rate = rate
+        self.schedule = schedule or []
+        self.burst = burst
+
+        self._lock = threading.Lock()
+        self._tokens = None  # full, at first
+        self._last = time.time()
+
+    def current_rate(self):
+        """Return the rate in force at this time of the day."""
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.rate
+
+    def consume(self, n):
+        """Take n bytes from the bucket, waiting until they are allowed to go."""
+        rate = self.current_rate()
+
+        with self._lock:
+            now = time.time()
+            if not rate:
+                self._tokens, self._last = None, now
+                return
+
+            # refill, then go in debt: who comes next waits for it to be paid back
+            if self._tokens is None:
+                self._tokens = self.burst * rate
+            self._tokens = min(self._tokens + (now - self._last) * rate, self.burst * rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def split(self, n):
+        """Return a bucket allowing 1/n of the rate of this one, for n processes sharing it."""
+        return TokenBucket(
+            self.rate / float(n), [(start, end, rate / float(n)) for start, end, rate in self.schedule], self.burst)
+
+
+class ReadAhead(object):
+
+    """Read files in memory before they are needed, keeping them under a memory cap.
+
+    The files are read by a few threads, in the order they are going to be uploaded."""
+
+    def __init__(self, paths, cap, threads=READ_AHEAD_THREADS):
+        """Start reading paths, a list of (local path, size), using at most cap bytes at once."""
+        self.cap = cap
+        self._paths = [(path, size) for path, size in paths if size <= cap]
+        self._next = 0
+        self._used = 0
+        self._files = {}  # local path -> None (being read), or its content
+        self._done = set()  # paths not to be read anymore
+        self._stopped = False
+        self._cond = threading.Condition()
+
+        self._threads = [
+            threading.Thread(
+                target=self._read_files,
+                name="{}-read-ahead-{}".format(threading.current_thread().name, i),
+            )
+            for i in range(min(threads, len(self._paths)))
+        ]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _read_files(self):
+        while True:
+            with self._cond:
+                while not self._stopped and self._next < len(self._paths) and \
+                        self._used + self._paths[self._next][1] > self.cap:
+                    self._cond.wait()
+                if self._stopped or self._next >= len(self._paths):
+                    return
+
+                path, size = self._paths[self._next]
+                self._next += 1
+                if path in self._done:
+                    continue
+                self._files[path] = None
+                self._used += size
+
+            data = bytearray(size)
+            try:
+                with io.open(path, 'rb', buffering=0) as f:
+                    n = f.readinto(data)
+                    if n != size or f.read(1):
+                        data = None  # changed in the meantime, read it later
+            except (IOError, OSError):
+                data = None
+
+            with self._cond:
+                if data is None:
+                    del self._files[path]
+                    self._used -= size
+                else:
+                    self._files[path] = data
+                self._cond.notify_all()
+
+    def take(self, path):
+        """Return the content of path (a bytearray), None if it hasn't been read (then, it won't be).
+
+        Its memory is accounted for until `release` is called."""
+        with self._cond:
+            self._done.add(path)
+            while path in self._files and self._files[path] is None:
+                self._cond.wait()
+            return self._files.pop(path, None)
+
+    def release(self, size):
+        """Give back the memory of the content of a file, once sent."""
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+    def stop(self):
+        """Stop reading, and wait for the reading threads."""
+        with self._cond:
+            self._stopped = True
+            self._files.clear()
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+
+class LocalScanner(object):
+
+    """List local directories ahead of the comparison with the remote ones, with several threads.
+
+    Useful where each listing costs a round trip, e.g. on network file systems.
+    The tree is walked breadth-first, from the directories added."""
+
+    def __init__(self, list_directory, is_excluded, threads, ahead=LOCAL_SCAN_AHEAD):
+        """Use list_directory (a relative path -> {name: lstat} function) to list up to ahead directories
+        not yet taken, skipping the excluded ones."""
+        self._list = list_directory
+        self._is_excluded = is_excluded
+        self._ahead = ahead
+        self._queue = deque()
+        self._results = {}  # relative path -> None (being listed), its entries or the error
+        self._taken = set()  # relative paths listed by who needed them
+        self._stopped = False
+        self._cond = threading.Condition()
+
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                name="{}-local-scan-{}".format(threading.current_thread().name, i),
+            )
+            for i in range(threads)
+        ]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def add(self, relative_path):
+        """List relative_path, and the directories below it."""
+        with self._cond:
+            self._queue.append(relative_path)
+            self._cond.notify()
+
+    def add_children(self, relative_path, entries):
+        """List the directories among entries, the listing of relative_path."""
+        for name, st in entries.items():
+            path = path_join(relative_path, name)
+            if S_ISDIR(st.st_mode) and not self._is_excluded(path):
+                self.add(path)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._queue or len(self._results) >= self._ahead):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+                relative_path = self._queue.popleft()
+                if relative_path in self._taken:
+                    self._taken.discard(relative_path)
+                    continue
+                self._results[relative_path] = None
+
+            try:
+                result = self._list(relative_path)
+                self.add_children(relative_path, result)
+            except EnvironmentError as e:
+                result = e
+
+            with self._cond:
+                self._results[relative_path] = result
+                self._cond.notify_all()
+
+    def take(self, relative_path):
+        """Return the entries of relative_path, None if it hasn't been listed (then, it won't be).
+
+        The errors met while listing it are raised here."""
+        with self._cond:
+            if relative_path not in self._results:
+                self._taken.add(relative_path)
+                return None
+            while self._results[relative_path] is None:
+                self._cond.wait()
+            result = self._results.pop(relative_path)
+            self._cond.notify_all()
+
+        if isinstance(result, EnvironmentError):
+            raise result
+        return result
+
+    def stop(self):
+        """Stop listing, and wait for the listing threads."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+
+class ConcurrencyController(object):
+
+    """Adjust the number of uploading channels, and the write requests in flight on each one,
+    to the measured round-trip time and throughput.
+
+    Like TCP congestion control, channels are added one by one while the throughput holds
+    and the round-trip time doesn't grow, and their number is cut by a quarter when it does."""
+
+    def __init__(self, max_channels, probe, interval=1.0, request_size=paramiko.SFTPFile.MAX_REQUEST_SIZE):
+        """Allow up to max_channels, measuring the round-trip time by calling probe every interval seconds.
+
+        The write requests in flight are counted in requests of request_size bytes."""
+        self.max_channels = max_channels
+        self.request_size = request_size
+        self.channels = min(2, max_channels)
+        self.depth = MIN_PIPELINE_DEPTH
+        self.rtt = None  # smoothed, in seconds
+        self.base_rtt = None  # the lowest one, with no queues along the way
+        self.throughput = 0.0  # bytes/sec
+
+        self._probe = probe
+        self._interval = interval
+        self._sent = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="{}-controller".format(threading.current_thread().name))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def sent(self, n):
+        """Account for n bytes sent."""
+        with self._cond:
+            self._sent += n
+
+    def admits(self, channel, timeout=0.5):
+        """Wait up to timeout seconds for channel (its index) to be allowed to upload, and tell whether it is."""
+        with self._cond:
+            if channel >= self.channels and not self._stopped:
+                self._cond.wait(timeout)
+            return channel < self.channels or self._stopped
+
+    def update(self, throughput, rtt):
+        """Adjust the concurrency to a new measure of throughput (bytes/sec) and round-trip time (seconds)."""
+        with self._cond:
+            if self.base_rtt is None or rtt < self.base_rtt:
+                self.base_rtt = rtt
+            self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+
+            # some slack, for the noise of short round trips
+            queueing = self.rtt > 1.5 * self.base_rtt + 0.005
+            if queueing or throughput < 0.8 * self.throughput:
+                self.channels = max(1, self.channels * 3 // 4)
+            elif throughput >= 0.95 * self.throughput:
+                self.channels = min(self.max_channels, self.channels + 1)
+            self.throughput = throughput
+
+            # twice each channel's share of the bandwidth-delay product
+            bdp_requests = throughput * self.rtt / float(self.request_size) / self.channels
+            self.depth = int(min(MAX_PIPELINE_DEPTH, max(MIN_PIPELINE_DEPTH, 2 * bdp_requests + 1)))
+            self._cond.notify_all()
+
+    def _run(self):
+        last = time.time()
+        while True:
+            with self._cond:
+                self._cond.wait(self._interval)
+                if self._stopped:
+                    return
+                sent, self._sent = self._sent, 0
+
+            start = time.time()
+            try:
+                self._probe()
+            except (IOError, EnvironmentError, paramiko.SSHException):
+                continue
+            now = time.time()
+
+            self.update(sent / (now - last), now - start)
+            last = now
+
+
+class Journal(object):
+
+    """Record a sync plan, then its actions as they are completed, in a local file.
+
+    An interrupted sync resumes from it with the actions left, without scanning the trees again.
+    The file holds a JSON record per line: the plan first, then the completed actions."""
+
+    def __init__(self, path, identity):
+        """Keep the journal at path, for the sync identified by identity (a JSON list)."""
+        self.path = path
+        self.identity = identity
+        self._fd = None
+
+    @staticmethod
+    def _action_to_json(a):
+        st = [a.st.st_mode, a.st.st_size, a.st.st_uid, a.st.st_gid, a.st.st_atime, a.st.st_mtime]
+        return [a.kind, a.path, a.size, st, a.source]
+
+    @staticmethod
+    def _action_from_json(record):
+        kind, path, size, st, source = record
+        return Action(kind, path, size, Stat(*st), source)
+
+    def resume(self):
+        """Return the actions left by an interrupted sync, None if there's nothing to resume.
+
+        Appending to the journal goes on."""
+        try:
+            with io.open(self.path, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return None
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:  # cut short by the interruption (an action to redo)
+                continue
+        if not records or records[0].get("sync") != self.identity:
+            return None
+
+        done = set(tuple(r["done"]) for r in records[1:] if "done" in r)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        return [
+            a for a in map(self._action_from_json, records[0]["plan"])
+            if (a.kind, a.path) not in done
+        ]
+
+    def start(self, plan):
+        """Record a new plan, replacing the previous journal."""
+        tmp_path = self.path + ".tmp"
+        with io.open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"sync": self.identity, "plan": [self._action_to_json(a) for a in plan]}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def done(self, action):
+        """Record a completed action.
+
+        Each record is a single append: the upload threads (and processes) share the journal."""
+        if self._fd is not None:
+            os.write(self._fd, (json.dumps({"done": [action.kind, action.path]}) + "\n").encode("utf-8"))
+
+    def close(self, completed=False):
+        """Stop recording, and remove the journal once the sync is completed."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if completed and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _Replies(object):
+    """Keep the replies to pipelined requests, if they arrive before the one being waited for.
+
+    paramiko hands them to the object given to `SFTPClient._async_request`."""
+
+    def __init__(self):
+        self.received = {}
+
+    def _async_response(self, t, msg, num):
+        self.received[num] = (t, msg)
+
+    def wait(self, sftp, num):
+        """Return the reply to the request num, raising IOError if it's an error status."""
+        if num not in self.received:
+            return sftp._read_response(num)
+        t, msg = self.received.pop(num)
+        if t == CMD_STATUS:
+            sftp._convert_status(msg)
+        return t, msg
+
+
+class Capabilities(object):
+
+    """What the SFTP server can do besides the baseline SFTPv3 requests, probed once connected.
+
+    The transfers and the scan check them to use the cheapest requests available."""
+
+    def __init__(self, extensions=None, limits=None, exec_probe=None):
+        """Hold the advertised extensions (name -> data), the `limits@openssh.com` ones
+        (max packet, read and write lengths, open handles; 0 if unknown) and a function
+        telling whether exec is allowed, called the first time it's needed."""
+        self.extensions = extensions or {}
+        self.max_packet_length, self.max_read_length, self.max_write_length, self.max_open_handles = \
+            limits or (0, 0, 0, 0)
+        self._exec_probe = exec_probe
+        self._exec_allowed = None
+
+    @property
+    def exec_allowed(self):
+        """Whether the server executes commands, probed once: most syncs never need it."""
+        if self._exec_allowed is None:
+            self._exec_allowed = bool(self._exec_probe and self._exec_probe())
+        return self._exec_allowed
+
+    def supports(self, extension):
+        """Tell whether the server advertised the given extension (e.g. `posix-rename@openssh.com`)."""
+        return extension in self.extensions
+
+    @property
+    def write_length(self):
+        """The largest write request the server accepts (the 32 KiB every server must, if it didn't tell)."""
+        return self.max_write_length or paramiko.SFTPFile.MAX_REQUEST_SIZE
+
+    def __str__(self):
+        return "extensions: {}; write requests up to {} bytes; exec {}".format(
+            ", ".join(sorted(self.extensions)) or "none", self.write_length,
+            "not probed" if self._exec_allowed is None else "" if self._exec_allowed else "not allowed")
+
+
+class _SFTPClient(paramiko.SFTPClient):
+
+    """An SFTP client sending file names as the very bytes they are on disk (see `fsencode`).
+
+    paramiko encodes them as UTF-8, failing on those which aren't valid UTF-8, and decodes the names
+    read from the server likewise: here they are decoded as the local ones are (see `fsdecode`)."""
+
+    def _adjust_cwd(self, path):
+        return paramiko.SFTPClient._adjust_cwd(self, fsencode(path))
+
+    def _async_request(self, fileobj, t, *arg):
+        arg = [fsencode(item) if isinstance(item, paramiko.py3compat.text_type) else item for item in arg]
+        return paramiko.SFTPClient._async_request(self, fileobj, t, *arg)
+
+    def symlink(self, source, dest):
+        return paramiko.SFTPClient.symlink(self, fsencode(source), dest)
+
+    def readlink(self, path):
+        destination = paramiko.SFTPClient.readlink(self, path)
+        return fsdecode(destination) if isinstance(destination, bytes) else destination
+
+    def listdir_attr(self, path="."):
+        return list(self.listdir_iter(path))
+
+    def listdir_iter(self, path=".", read_aheads=50):
+        """Yield the attributes of each entry of the directory at path, with read_aheads READDIR requests in flight.
+
+        Unlike paramiko's, it lets other requests be sent on the same channel in the meantime."""
+        t, msg = self._request(CMD_OPENDIR, self._adjust_cwd(path))
+        if t != CMD_HANDLE:
+            raise SFTPError("Expected handle")
+        handle = msg.get_binary()
+
+        replies = _Replies()
+        pending = deque(self._async_request(replies, CMD_READDIR, handle) for _ in range(max(read_aheads, 1)))
+        try:
+            while pending:
+                try:
+                    t, msg = replies.wait(self, pending.popleft())
+                except EOFError:  # the end of the directory
+                    break
+                if t != CMD_NAME:
+                    raise SFTPError("Expected name response")
+                pending.append(self._async_request(replies, CMD_READDIR, handle))
+                for _ in range(msg.get_int()):
+                    filename = fsdecode(msg.get_string())
+                    longname = msg.get_string().decode("utf-8", "replace")
+                    attr = paramiko.SFTPAttributes._from_msg(msg, filename, longname)
+                    if filename not in (".", ".."):
+                        yield attr
+        finally:
+            try:
+                for num in pending:  # most likely, the end of the directory too
+                    try:
+                        replies.wait(self, num)
+                    except EOFError:
+                        pass
+                self._request(CMD_CLOSE, handle)
+            except (EnvironmentError, paramiko.SSHException):
+                pass  # the connection has been lost, as the error being raised tells
+
+
+class _ProbingSFTPClient(_SFTPClient):
+
+    """An SFTP client keeping the extensions advertised by the server with its version (name -> data)."""
+
+    extensions = {}
+
+    def _send_version(self):
+        read_packet = self._read_packet
+
+        def read_version():
+            t, data = read_packet()
+            if t == CMD_VERSION:
+                msg = paramiko.Message(data[4:])
+                extensions = {}
+                while msg.packet.tell() < len(data) - 4:
+                    name = msg.get_text()
+                    extensions[name] = msg.get_string().decode("utf-8", "replace")
+                self.extensions = extensions
+            return t, data
+
+        self._read_packet = read_version
+        try:
+            return _SFTPClient._send_version(self)
+        finally:
+            del self._read_packet
 
 
 def parse_username_password_hostname(remote_url):
@@ -122,10 +954,28 @@ class SFTPClone(object):
                  ssh_config_path=None, ssh_agent=False,
                  exclude_file=None, known_hosts_path=None,
                  delete=True, allow_unknown=False,
-                 create_remote_directory=False,
+                 create_remote_directory=False, hard_links=False,
+                 dedupe=False, transport=None,
+                 channels=DEFAULT_CHANNELS, dry_run=False, plan_json=False,
+                 bwlimit=None, connections=DEFAULT_CONNECTIONS,
+                 processes=DEFAULT_PROCESSES, chunked_size=CHUNKED_FILE_SIZE,
+                 verify=False, read_ahead=0, adaptive=False,
+                 scan_channels=DEFAULT_SCAN_CHANNELS, local_threads=0,
+                 listing_requests=DEFAULT_LISTING_REQUESTS, journal_path=None,
+                 retries=DEFAULT_RETRIES, atomic=True, releases=0, git=False,
+                 files_from=None, credentials=None,
                  ):
-        """Init the needed parameters and the SFTPClient."""
+        """Init the needed parameters and the SFTPClient.
+
+        If an authenticated transport is given, it is used instead of connecting again:
+        with the `credentials` of the instance which opened it, more connections can be opened too.
+        Otherwise, up to connections SSH connections are opened, sharing the work.
+        With more than one process, uploads are split among forked processes, each with its own connections.
+        With releases, each run deploys a new release directory instead (see `deploy_release`).
+        With git, only what changed since the last deployed commit is synced (see `git_plan`).
+        With files_from (a file, or - for the standard input), only the paths listed there are synced."""
         self.local_path = os.path.realpath(os.path.expanduser(local_path))
+        self._local_prefix = path_join(self.local_path, "")  # local paths are this + the relative one
         self.logger = logger or configure_logging()
 
         self.create_remote_directory = create_remote_directory
@@ -139,20 +989,35 @@ class SFTPClone(object):
                 # As in rsync's exclude from, ignore lines with leading ; and #
                 # and treat each path as relative (thus by removing the leading
                 # /)
-                exclude_list = [
+                self.exclude_patterns = [
                     line.rstrip().lstrip("/")
                     for line in f
                     if not line.startswith((";", "#"))
                 ]
-
-                # actually, is a set of excluded files
-                self.exclude_list = {
-                    g
-                    for pattern in exclude_list
-                    for g in glob.glob(path_join(self.local_path, pattern))
-                }
         else:
-            self.exclude_list = set()
+            self.exclude_patterns = []
+
+        # sync the listed paths only, instead of scanning the trees
+        self.paths = None
+        if files_from:
+            try:
+                if files_from == "-":
+                    content = getattr(sys.stdin, "buffer", sys.stdin).read()
+                else:
+                    with open(os.path.expanduser(files_from), 'rb') as f:
+                        content = f.read()
+                self.paths = parse_path_list(fsdecode(content))
+            except (IOError, ValueError) as e:
+                self.logger.error("Bad list of paths: {}. Exiting.".format(e))
+                sys.exit(1)
+
+        # sync what git says changed, instead of scanning the trees
+        self.git = git or False
+        if self.git:  # the repository itself isn't deployed
+            self.exclude_patterns.append(".git")
+
+        # actually, is a set of excluded files
+        self.exclude_list = self._glob_exclude_patterns()
 
         username, password, hostname, self.remote_path = parse_username_password_hostname(remote_url)
 
@@ -188,6 +1053,182 @@ class SFTPClone(object):
         self.fix_symlinks = fix_symlinks or False
         self.delete = delete if delete is not None else True
 
+        # (st_dev, st_ino) of local hard-linked files -> first remote path
+        self.hard_links = hard_links or False
+        self._inodes = {}
+
+        # content digest -> remote path of a synced copy
+        self.dedupe = dedupe or False
+        self._digests = {}
+        # size -> [(local path, remote path)] of up to date (or uploaded) files, hashed lazily
+        self._unhashed = {}
+        self._hashed_sizes = set()
+
+        self.channels = channels or DEFAULT_CHANNELS
+        self.scan_channels = scan_channels or DEFAULT_SCAN_CHANNELS
+        self.listing_requests = listing_requests or DEFAULT_LISTING_REQUESTS
+        # threads listing local directories ahead of the comparison (0: the scanning ones do)
+        self.local_threads = local_threads or 0
+        self._local_scanner = None
+        # print the plan instead of executing it
+        self.dry_run = dry_run or plan_json
+        self.plan_json = plan_json or False
+
+        self.bandwidth = None  # shared by all the uploads
+        if bwlimit:
+            try:
+                self.bandwidth = TokenBucket(*parse_bwlimit(bwlimit))
+            except ValueError as e:
+                self.logger.error("Bad bandwidth limit: {}. Exiting.".format(e))
+                sys.exit(1)
+
+        self.processes = processes or DEFAULT_PROCESSES
+        # split larger files into chunks (0: never), check them after the upload
+        self.chunked_size = chunked_size if chunked_size is not None else CHUNKED_FILE_SIZE
+        self.verify = verify or False
+        # upload files to a temporary name, then rename them over the old ones
+        self.atomic = atomic if atomic is not None else True
+        self._chunk_targets = {}  # path of chunked files -> temporary remote path
+        # deploy to a new directory each time, keeping this many of them (0: sync in place)
+        self.releases = releases or 0
+        self._previous_release = None  # what the new release is compared with, while it's deployed
+        # a reusable read buffer, for each uploading thread
+        self._buffers = threading.local()
+        # memory cap of the files read ahead of their upload (0: don't)
+        self.read_ahead = read_ahead or 0
+        self._read_ahead = None
+        # adjust the concurrency of uploads to the network
+        self.adaptive = adaptive or False
+        self._controller = None
+        # what has been done, by kind
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        # reconnect (and retry) when the connection is lost
+        self.retries = retries if retries is not None else DEFAULT_RETRIES
+        self._reconnect_lock = threading.Lock()
+        # temporary files to remove once reconnected (see `_discard`)
+        self._leftovers = []
+
+        # only root can change file owner
+        if username == 'root':
+            self.chown = True
+
+        # what is needed to open more connections, once the first one succeeded
+        self._agent = None
+        self._ssh_target = None
+        self._auth = None
+        self._host_key = None
+
+        if transport is None:
+            transport = self._connect(
+                hostname, port, username, password, identity_files,
+                proxy_command, ssh_agent, known_hosts_path, allow_unknown,
+            )
+        elif credentials is not None:
+            self._ssh_target, self._auth, self._host_key, self._agent = credentials
+
+        self.transport = transport
+        self.transports = [transport]
+        while self._auth is not None and len(self.transports) < (connections or DEFAULT_CONNECTIONS):
+            try:
+                self.transports.append(self._open_transport())
+            except (socket.error, paramiko.SSHException) as e:
+                self.logger.warning(
+                    "Can't open more than {} SSH connections: {}".format(len(self.transports), e))
+                break
+
+        self.sftp = _ProbingSFTPClient.from_transport(self.transport)
+        # guards the comparison of the trees, when scanned by several threads
+        self._scan_lock = threading.Lock()
+
+        self.capabilities = self._probe_capabilities()
+        self.logger.debug("Server capabilities: %s.", self.capabilities)
+        # a block split into write requests leaves none of them short, the last one of a file aside
+        write_length = self.capabilities.write_length
+        self._block_size = max(1, UPLOAD_BLOCK_SIZE // write_length) * write_length
+        # until the server proves otherwise
+        self._remote_hardlink = self.capabilities.supports("hardlink@openssh.com")
+        self._remote_copy_data = self.capabilities.supports("copy-data")
+        self._remote_cp = True  # if exec is allowed, probed on the first copy
+        if self.hard_links and not self._remote_hardlink:
+            self.logger.warning("Server can't create hard links. Uploading every link name instead.")
+        if self.dedupe and not (self._remote_copy_data or self.capabilities.exec_allowed):
+            self.logger.warning("Server can't copy files. Uploading duplicates instead.")
+            self.dedupe = False
+        if self.verify and not self.capabilities.supports("check-file"):
+            self.logger.warning("The server can't hash files, uploads won't be checked.")
+            self.verify = False
+
+        if self.remote_path.startswith("~"):
+            # nasty hack to let getcwd work without changing dir!
+            self.sftp.chdir('.')
+            self.remote_path = self.remote_path.replace(
+                "~", self.sftp.getcwd())  # home is the initial sftp dir
+
+        # completed actions are recorded there, to resume an interrupted sync
+        self.journal = None
+        if journal_path and self.releases:
+            self.logger.warning("An interrupted release is deployed again from scratch, the journal is ignored.")
+        elif journal_path:
+            self.journal = Journal(
+                os.path.expanduser(journal_path),
+                [hostname, self.local_path, self.remote_path, self._plan_options_digest()])
+
+    def _plan_options_digest(self):
+        """Return a digest of the options the plan depends on (the listed paths included).
+
+        An interrupted sync is resumed only by a sync with the same ones."""
+        options = [
+            self.delete, self.exclude_patterns, self.paths, self.git,
+            self.fix_symlinks, self.hard_links, self.dedupe, self.chown,
+        ]
+        return hashlib.sha256(json.dumps(options).encode("utf-8")).hexdigest()
+
+    def _probe_capabilities(self):
+        """Return the `Capabilities` of the server: its extensions and limits, and how to probe exec."""
+        extensions = getattr(self.sftp, "extensions", {})
+
+        limits = None
+        if "limits@openssh.com" in extensions:
+            try:
+                _, msg = self.sftp._request(CMD_EXTENDED, "limits@openssh.com")
+                limits = tuple(msg.get_int64() for _ in range(4))
+            except (IOError, paramiko.SSHException) as e:
+                self.logger.debug("Can't read the server limits: {}".format(e))
+
+        return Capabilities(extensions, limits, self._probe_exec)
+
+    def _probe_exec(self):
+        """Tell whether the server executes commands, by running one whose output proves it did.
+
+        An account forced to run an SFTP server runs that instead, whatever the command:
+        it prints nothing, and exits fine on EOF."""
+        token = binascii.hexlify(os.urandom(8))
+        output = b""
+        try:
+            channel = self.transport.open_session()
+            try:
+                channel.settimeout(EXEC_PROBE_TIMEOUT)
+                channel.exec_command(b"echo " + token)
+                channel.shutdown_write()
+                data = channel.recv(1024)
+                while data:
+                    output += data
+                    data = channel.recv(1024)
+            finally:
+                channel.close()
+        except (paramiko.SSHException, socket.error, IOError) as e:
+            self.logger.debug("Can't execute commands: {}".format(e))
+        return token in output.split()
+
+    def _connect(self, hostname, port, username, password, identity_files,
+                 proxy_command, ssh_agent, known_hosts_path, allow_unknown):
+        """Connect to the SSH server, check its identity and authenticate.
+
+        The credentials that worked are kept, to open more connections later on.
+
+        :return: The authenticated transport.
+        """
         if ssh_agent:
             agent, agent_keys = get_ssh_agent_keys(self.logger)
         else:
@@ -199,10 +1240,6 @@ class SFTPClone(object):
             )
             sys.exit(1)
 
-        # only root can change file owner
-        if username == 'root':
-            self.chown = True
-
         sock = (hostname, port)
         if proxy_command is not None:
             sock = paramiko.proxy.ProxyCommand(proxy_command)
@@ -290,6 +1327,7 @@ class SFTPClone(object):
                         username=username,
                         key=pkey
                     )
+                    self._auth = (username, None, pkey)
                     return True
                 except paramiko.SSHException:
                     self.logger.warning(
@@ -302,6 +1340,7 @@ class SFTPClone(object):
                     username=username,
                     password=password
                 )
+                self._auth = (username, password, None)
             elif agent_keys:  # SSH agent keys have higher priority
                 for pkey in agent_keys:
                     if perform_key_auth(pkey):
@@ -346,18 +1385,147 @@ class SFTPClone(object):
                 "None of the provided authentication methods worked. Exiting."
             )
             transport.close()
-            sys.exit(1)
-        finally:
             if agent:
                 agent.close()
+            sys.exit(1)
 
-        self.sftp = paramiko.SFTPClient.from_transport(transport)
+        # agent keys need the agent to sign, later on
+        self._agent = agent
+        self._ssh_target = (hostname, port, proxy_command)
+        self._host_key = transport.get_remote_server_key()
+        return transport
 
-        if self.remote_path.startswith("~"):
-            # nasty hack to let getcwd work without changing dir!
-            self.sftp.chdir('.')
-            self.remote_path = self.remote_path.replace(
-                "~", self.sftp.getcwd())  # home is the initial sftp dir
+    @property
+    def credentials(self):
+        """What's needed to open more connections like the first one (None if it was given),
+        to be passed along with it to another instance."""
+        if self._auth is None:
+            return None
+        return self._ssh_target, self._auth, self._host_key, self._agent
+
+    def _open_transport(self):
+        """Open one more SSH connection, with the credentials of the first one.
+
+        The server must present the same host key, already checked.
+
+        :return: The authenticated transport.
+        """
+        hostname, port, proxy_command = self._ssh_target
+        sock = (hostname, port)
+        if proxy_command is not None:
+            sock = paramiko.proxy.ProxyCommand(proxy_command)
+
+        transport = paramiko.Transport(sock)
+        try:
+            transport.get_security_options().key_types = (self._host_key.get_name(),)
+            transport.start_client()
+            if transport.get_remote_server_key().asbytes() != self._host_key.asbytes():
+                raise paramiko.SSHException("the remote key fingerprint changed")
+
+            username, password, pkey = self._auth
+            if pkey is not None:
+                transport.auth_publickey(username=username, key=pkey)
+            else:
+                transport.auth_password(username=username, password=password)
+        except Exception:
+            transport.close()
+            raise
+
+        return transport
+
+    def _open_clients(self, n):
+        """Return up to n SFTP sessions, starting from self.sftp, spread over the SSH connections.
+
+        The caller closes all of them, but the first one."""
+        clients = [self.sftp]
+        while len(clients) < n:
+            transport = self.transports[len(clients) % len(self.transports)]
+            try:
+                clients.append(_SFTPClient.from_transport(transport))
+            except paramiko.SSHException as e:
+                self.logger.warning(
+                    "Can't open more than {} SFTP channels: {}".format(len(clients), e))
+                break
+        return clients
+
+    @staticmethod
+    def _connection_lost(sftp):
+        """Tell whether the SFTP session, or its SSH connection, has been closed."""
+        channel = sftp.get_channel()
+        return channel is None or channel.closed or not channel.get_transport().is_active()
+
+    def _reconnect(self, sftp):
+        """Return a new SFTP session replacing sftp, whose channel has been closed.
+
+        Its SSH connection is opened again if it has been lost too (see `_open_transport`)."""
+        with self._reconnect_lock:
+            transport = sftp.get_channel().get_transport()
+            if transport not in self.transports:
+                # already replaced, by another thread
+                transport = self.transports[0]
+            if not transport.is_active():
+                if self._auth is None:
+                    raise paramiko.SSHException("can't reconnect without the credentials of the first connection")
+                new_transport = self._open_transport()
+                transport.close()
+                self.transports = [new_transport if t is transport else t for t in self.transports]
+                if self.transport is transport:
+                    self.transport = new_transport
+                transport = new_transport
+
+            new_sftp = _SFTPClient.from_transport(transport)
+            if sftp is self.sftp:
+                self.sftp = new_sftp
+            return new_sftp
+
+    def _retry(self, operation, sftp=None, done=None):
+        """Call operation with an SFTP session (self.sftp by default) and return the session it ended up using.
+
+        If the connection is lost meanwhile, it's opened again and operation retried (from scratch),
+        up to self.retries times, waiting twice as long each time.
+        Any other error is raised at once, unless done(sftp), if given, tells that the operation
+        had been performed before the connection was lost, with its reply (e.g. a mkdir, retried)."""
+        sftp = sftp or self.sftp
+        lost = None  # the session to replace
+        delay = RETRY_DELAY
+        attempt = 0
+        while True:
+            try:
+                if lost is not None:
+                    sftp, lost = self._reconnect(lost), None
+                    self._discard_leftovers(sftp)
+                operation(sftp)
+                return sftp
+            except (EnvironmentError, EOFError, paramiko.SSHException) as e:
+                if lost is None:
+                    if not self._connection_lost(sftp):
+                        if attempt and done is not None and done(sftp):
+                            return sftp
+                        raise
+                    lost = sftp
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.logger.warning("Connection lost ({}), retrying in {:g} seconds ({}/{}).".format(
+                    e, delay, attempt, self.retries))
+                time.sleep(delay)
+                delay *= 2
+
+    def _glob_exclude_patterns(self):
+        """Return the set of local paths matching the exclude patterns."""
+        return {
+            g
+            for pattern in self.exclude_patterns
+            for g in glob.glob(path_join(self.local_path, pattern))
+        }
+
+    def _is_excluded(self, relative_path):
+        """Return True if relative_path, or any of its parents, is excluded."""
+        while relative_path:
+            if path_join(self.local_path, relative_path) in self.exclude_list:
+                return True
+            relative_path = os.path.dirname(relative_path)
+        return False
 
     @staticmethod
     def _file_need_upload(l_st, r_st):
@@ -381,18 +1549,356 @@ class SFTPClone(object):
 
         return False
 
-    def _match_modes(self, remote_path, l_st):
-        """Match mod, utime and uid/gid with locals one."""
-        self.sftp.chmod(remote_path, S_IMODE(l_st.st_mode))
-        self.sftp.utime(remote_path, (l_st.st_atime, l_st.st_mtime))
-
+    @staticmethod
+    def _attrs_differ(l_st, r_st, owner=False):
+        """Return True if mode or mtime (and uid/gid, if owner is True) don't match."""
+        return S_IMODE(l_st.st_mode) != S_IMODE(r_st.st_mode or 0) or \
+            r_st.st_mtime is None or int(l_st.st_mtime) != r_st.st_mtime or \
+            (owner and (l_st.st_uid != r_st.st_uid or l_st.st_gid != r_st.st_gid))
+
+    def _match_modes(self, remote_path, l_st, sftp=None):
+        """Match mod, utime and uid/gid with locals one, with a single request."""
+        sftp = sftp or self.sftp
+        attr = paramiko.SFTPAttributes()
+        attr.st_mode = S_IMODE(l_st.st_mode)
+        attr.st_atime, attr.st_mtime = l_st.st_atime, l_st.st_mtime
         if self.chown:
-            self.sftp.chown(remote_path, l_st.st_uid, l_st.st_gid)
+            attr.st_uid, attr.st_gid = l_st.st_uid, l_st.st_gid
+        sftp._request(CMD_SETSTAT, remote_path, attr)
+
+    def _atomic_uploads(self):
+        """Tell whether files are uploaded to a temporary name, then renamed (see `file_upload`).
+
+        Nothing uses a new release yet: its files are written in place."""
+        return self.atomic and not self.releases and self.capabilities.supports("posix-rename@openssh.com")
+
+    @staticmethod
+    def _temp_path(remote_path):
+        """Return a hidden, unique name next to remote_path, to upload it to."""
+        directory, name = os.path.split(remote_path)
+        return path_join(directory, ".{}.{}.part".format(
+            name[:200], binascii.hexlify(os.urandom(4)).decode("ascii")))
 
-    def file_upload(self, local_path, remote_path, l_st):
-        """Upload local_path to remote_path and set permission and mtime."""
-        self.sftp.put(local_path, remote_path)
-        self._match_modes(remote_path, l_st)
+    def _discard(self, sftp, remote_path):
+        """Remove what's left of a failed upload, if possible.
+
+        If the connection has been lost, it's removed once it's back (see `_retry`)."""
+        try:
+            sftp.remove(remote_path)
+        except (IOError, EOFError, paramiko.SSHException):
+            if self._connection_lost(sftp):
+                with self._reconnect_lock:
+                    self._leftovers.append(remote_path)
+
+    def _discard_leftovers(self, sftp):
+        """Remove the files `_discard` couldn't, with the new SFTP session sftp."""
+        with self._reconnect_lock:
+            leftovers, self._leftovers = self._leftovers, []
+        for remote_path in leftovers:
+            self._discard(sftp, remote_path)
+
+    @staticmethod
+    def _exists(sftp, remote_path, directory=False):
+        """Tell whether remote_path exists (and is a directory, if asked)."""
+        try:
+            st = sftp.lstat(remote_path)
+        except IOError:
+            return False
+        return S_ISDIR(st.st_mode) or not directory
+
+    @staticmethod
+    def _same_file(sftp, remote_path, other_path):
+        """Tell whether two remote paths are hard links to the same regular file.
+
+        SFTP doesn't tell inode numbers: their attributes must be the same."""
+        try:
+            st, other_st = sftp.lstat(remote_path), sftp.lstat(other_path)
+        except IOError:
+            return False
+        attrs = ("st_mode", "st_size", "st_uid", "st_gid", "st_mtime")
+        return S_ISREG(st.st_mode) and all(getattr(st, a) == getattr(other_st, a) for a in attrs)
+
+    def _count(self, kind, size=0):
+        """Add an action of the given kind (and the bytes it sent) to the statistics."""
+        with self._stats_lock:
+            self.stats[kind] += 1
+            self.stats["bytes"] += size
+
+    def _done(self, action):
+        """Record in the journal (if any) that action has been completed."""
+        if self.journal is not None:
+            self.journal.done(action)
+
+    def _open_for_writing(self, sftp, remote_path, mode='wb'):
+        """Open remote_path for pipelined writes, each request as large as the server accepts."""
+        rf = sftp.open(remote_path, mode, bufsize=0)
+        rf.set_pipelined(True)
+        rf.MAX_REQUEST_SIZE = self.capabilities.write_length
+        return rf
+
+    def _write_view(self, rf, view, start, end):
+        """Write the bytes of view (a memoryview) from start to end to the remote file rf, block by block."""
+        for block_start in range(start, end, self._block_size):
+            block_end = min(block_start + self._block_size, end)
+            if self.bandwidth is not None:
+                self.bandwidth.consume(block_end - block_start)
+            rf.write(view[block_start:block_end])
+
+            controller = self._controller
+            if controller is not None:
+                controller.sent(block_end - block_start)
+                # wait for the oldest requests, to keep depth of them in flight
+                self._wait_writes(rf, controller.depth)
+
+    @staticmethod
+    def _wait_writes(rf, depth=0):
+        """Wait for the replies to the writes to rf until at most depth of them are in flight.
+
+        paramiko drops the replies to pipelined writes, even the failed ones:
+        here, IOError is raised if any of them failed."""
+        while len(rf._reqs) > depth:
+            rf.sftp._read_response(rf._reqs.popleft())
+
+    def _send(self, lf, rf, offset, length):
+        """Write length bytes of the local file lf, from offset, to the remote file rf (at its position).
+
+        Large files are memory-mapped, the others read into a reusable buffer:
+        either way, the SFTP layer gets slices of them, without copies."""
+        mapped = view = None
+        if length >= MMAP_MIN_SIZE:
+            try:
+                mapped = mmap.mmap(lf.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+            except (EnvironmentError, ValueError):
+                pass  # e.g. it shrank, or its file system doesn't support it
+            except TypeError:
+                pass  # Python 2.x, where memory maps can't be viewed
+            if view is None and mapped is not None:
+                mapped.close()
+
+        if view is not None:
+            if hasattr(mapped, "madvise"):  # Python >= 3.8
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            try:
+                if offset + length > len(view):
+                    raise IOError("{} shrank while uploading it".format(lf.name))
+                self._write_view(rf, view, offset, offset + length)
+            finally:
+                view.release()
+                mapped.close()
+            return
+
+        buf = getattr(self._buffers, "view", None)
+        if buf is None:
+            buf = self._buffers.view = memoryview(bytearray(self._block_size))
+
+        lf.seek(offset)
+        left = length
+        while left > 0:
+            n = lf.readinto(buf[:min(left, self._block_size)])
+            if not n:
+                raise IOError("{} shrank while uploading it".format(lf.name))
+            self._write_view(rf, buf, 0, n)
+            left -= n
+
+    def _send_sparse(self, lf, rf, offset, length):
+        """Like `_send`, but only the data extents of a sparse file are written, each one at its offset.
+
+        The remote file must have been given its size already (then, it's a hole):
+        it keeps holes in place of the local ones."""
+        if not is_sparse(lf.fileno()):
+            self._send(lf, rf, offset, length)
+            return
+
+        for start, size in data_extents(lf.fileno(), offset, offset + length):
+            rf.seek(start)
+            self._send(lf, rf, start, size)
+
+    def file_upload(self, local_path, remote_path, l_st, sftp=None):
+        """Upload local_path to remote_path and set permission and mtime.
+
+        In atomic mode, the file is uploaded to a hidden name in the same directory,
+        then renamed over remote_path: the remote file is never seen half-written."""
+        sftp = sftp or self.sftp
+
+        if not self._atomic_uploads():
+            self._write_file(local_path, remote_path, l_st, sftp)
+        else:
+            temp_path = self._temp_path(remote_path)
+            try:
+                self._write_file(local_path, temp_path, l_st, sftp)
+                sftp.posix_rename(temp_path, remote_path)
+            except Exception:
+                self._discard(sftp, temp_path)
+                raise
+        self._count(UPLOAD, l_st.st_size)
+
+    def _write_file(self, local_path, remote_path, l_st, sftp):
+        """Write the content of local_path to remote_path and set permission and mtime."""
+        data = self._read_ahead.take(local_path) if self._read_ahead is not None else None
+        if data is not None:
+            try:
+                with self._open_for_writing(sftp, remote_path) as rf:
+                    self._write_view(rf, memoryview(data), 0, len(data))
+                    self._wait_writes(rf)
+            finally:
+                self._read_ahead.release(len(data))
+            self._match_modes(remote_path, l_st, sftp)
+            return
+
+        with io.open(local_path, 'rb', buffering=0) as lf:
+            with self._open_for_writing(sftp, remote_path) as rf:
+                size = os.fstat(lf.fileno()).st_size
+                if is_sparse(lf.fileno()):
+                    # first a hole as large as the file (like the chunked ones),
+                    # some servers can't extend a file without emptying it
+                    rf.truncate(size)
+                self._send_sparse(lf, rf, 0, size)
+                self._wait_writes(rf)
+        self._match_modes(remote_path, l_st, sftp)
+
+    def remote_copy(self, copy_source, remote_path):
+        """Copy copy_source to remote_path without sending its content again.
+
+        Try the `copy-data` extension first, then an exec channel running `cp`.
+        Return False if the server can't do either of them."""
+        if self._remote_copy_data:
+            try:
+                with self.sftp.open(copy_source, 'rb') as src:
+                    with self.sftp.open(remote_path, 'wb') as dst:
+                        zero = paramiko.py3compat.long(0)
+                        # read the whole file (length 0) and write it at offset 0
+                        self.sftp._request(
+                            CMD_EXTENDED, "copy-data",
+                            src.handle, zero, zero, dst.handle, zero
+                        )
+                return True
+            except IOError as e:
+                if self._connection_lost(self.sftp):
+                    raise
+                self.logger.info("Server can't copy data ({}).".format(e))
+                self._remote_copy_data = False
+
+        if self._remote_cp and not self.capabilities.exec_allowed:
+            self._remote_cp = False
+        if self._remote_cp:
+            command = "cp --reflink=auto -- {} {}".format(
+                quote(copy_source), quote(remote_path)
+            )
+            try:
+                channel = self.transport.open_session()
+                try:
+                    channel.exec_command(fsencode(command))
+                    # nothing to send: an account forced to run an SFTP server exits, instead of waiting
+                    channel.shutdown_write()
+                    if not channel.status_event.wait(REMOTE_CP_TIMEOUT):
+                        raise IOError("no exit status after {} seconds".format(REMOTE_CP_TIMEOUT))
+                    status = channel.recv_exit_status()
+                finally:
+                    channel.close()
+
+                # exec may not see the same file system as the SFTP subsystem
+                if status == 0 and \
+                        self.sftp.lstat(remote_path).st_size == self.sftp.lstat(copy_source).st_size:
+                    return True
+                self.logger.info("Remote `{}` failed with status {}.".format(command, status))
+            except (paramiko.SSHException, IOError) as e:
+                if self._connection_lost(self.sftp):
+                    raise
+                self.logger.info("Server can't execute `{}` ({}).".format(command, e))
+            self._remote_cp = False
+
+        self.logger.warning("Server can't copy files. Uploading duplicates instead.")
+        self.dedupe = False
+        return False
+
+    def _dedupe_plan(self, plan):
+        """Turn the uploads of plan having the same content as another file, synced or uploaded, into copies.
+
+        It's done once the plan is complete, outside of the scan: only the files having the same size
+        as another one are hashed, the others are remembered in case one shows up later on."""
+        if not self.dedupe:
+            return
+
+        candidates = [i for i, a in enumerate(plan) if a.kind == UPLOAD and a.size >= DEDUPE_MIN_SIZE]
+        sizes = Counter(plan[i].size for i in candidates)
+        for i in candidates:
+            action = plan[i]
+            local_path = self._local_prefix + action.path
+            if sizes[action.size] < 2 and action.size not in self._unhashed and action.size not in self._hashed_sizes:
+                self._unhashed[action.size] = [(local_path, action.path)]
+                continue
+
+            copy_source = self._dedupe_source(local_path, action.path, action.size)
+            if copy_source:
+                plan[i] = Action(COPY, action.path, action.size, action.st, copy_source)
+
+    def _dedupe_source(self, local_path, relative_path, size):
+        """Return the relative path of an already synced file having the same content of local_path.
+
+        The first time a content is seen, relative_path is remembered and None is returned."""
+        # hash the files of the same size only when needed
+        for other_local, other_relative in self._unhashed.pop(size, ()):
+            try:
+                self._digests.setdefault(file_digest(other_local), other_relative)
+            except (IOError, OSError):
+                pass  # it disappeared in the meantime
+        self._hashed_sizes.add(size)
+
+        digest = file_digest(local_path)
+        if digest not in self._digests:
+            self._digests[digest] = relative_path
+            return None
+
+        return self._digests[digest]
+
+    def _dedupe_register(self, local_path, relative_path, l_st):
+        """Remember an up to date file as a possible source of server-side copies."""
+        if self.dedupe and l_st.st_size >= DEDUPE_MIN_SIZE:
+            self._unhashed.setdefault(l_st.st_size, []).append((local_path, relative_path))
+
+    def remote_hardlink(self, link_source, remote_path):
+        """Create remote_path as a hard link to link_source.
+
+        Uses the `hardlink@openssh.com` extension.
+        Return False if the server doesn't support it."""
+        if not self._remote_hardlink:
+            return False
+
+        try:  # the extension doesn't replace existing files
+            self.sftp.remove(remote_path)
+        except IOError:
+            pass
+
+        try:
+            self.sftp._request(
+                CMD_EXTENDED, "hardlink@openssh.com", link_source, remote_path
+            )
+        except IOError as e:
+            if self._connection_lost(self.sftp):
+                raise
+            self.logger.warning(
+                "Server can't create hard links ({}). "
+                "Uploading every link name instead.".format(e)
+            )
+            self._remote_hardlink = False
+            return False
+
+        return True
+
+    def _hard_link_source(self, relative_path, l_st):
+        """Return the relative path of an already seen link to the same local inode.
+
+        The first time an inode is seen, relative_path is remembered and None is returned."""
+        if not self.hard_links or not self._remote_hardlink or l_st.st_nlink < 2:
+            return None
+
+        inode = (l_st.st_dev, l_st.st_ino)
+        if inode not in self._inodes:
+            self._inodes[inode] = relative_path
+            return None
+
+        return self._inodes[inode]
 
     def remote_delete(self, remote_path, r_st):
         """Remove the remote directory node."""
@@ -408,189 +1914,1120 @@ class SFTPClone(object):
             try:
                 self.sftp.remove(remote_path)
             except FileNotFoundError as e:
+                if e.errno != errno.ENOENT:  # Python 2.x, where it's any IOError (e.g. the connection is lost)
+                    raise
                 self.logger.error(
                     "error while removing {}. trace: {}".format(remote_path, e)
                 )
 
-    def check_for_deletion(self, relative_path=None):
-        """Traverse the entire remote_path tree.
-
-        Find files/directories that need to be deleted,
-        not being present in the local folder.
-        """
-        if not relative_path:
-            relative_path = str()  # root of shared directory tree
-
-        remote_path = path_join(self.remote_path, relative_path)
-        local_path = path_join(self.local_path, relative_path)
-
-        for remote_st in self.sftp.listdir_attr(remote_path):
-            r_lstat = self.sftp.lstat(path_join(remote_path, remote_st.filename))
-
-            inner_remote_path = path_join(remote_path, remote_st.filename)
-            inner_local_path = path_join(local_path, remote_st.filename)
-
-            # check if remote_st is a symlink
-            # otherwise could delete file outside shared directory
-            if S_ISLNK(r_lstat.st_mode):
-                if self._must_be_deleted(inner_local_path, r_lstat):
-                    self.remote_delete(inner_remote_path, r_lstat)
-                continue
+    def create_update_symlink(self, link_destination, remote_path, replace=True):
+        """Create a new link pointing to link_destination in remote_path position.
 
-            if self._must_be_deleted(inner_local_path, remote_st):
-                self.remote_delete(inner_remote_path, remote_st)
-            elif S_ISDIR(remote_st.st_mode):
-                self.check_for_deletion(
-                    path_join(relative_path, remote_st.filename)
-                )
-
-    def create_update_symlink(self, link_destination, remote_path):
-        """Create a new link pointing to link_destination in remote_path position."""
+        Unless replace is False, anything already there is removed first."""
         try:  # if there's anything, delete it
-            self.sftp.remove(remote_path)
+            if replace:
+                self.sftp.remove(remote_path)
         except IOError:  # that's fine, nothing exists there!
             pass
         finally:  # and recreate the link
             try:
                 self.sftp.symlink(link_destination, remote_path)
             except OSError as e:
+                if self._connection_lost(self.sftp):
+                    raise
                 # Sometimes, if links are "too" different, symlink fails.
                 # Sadly, nothing we can do about it.
                 self.logger.error("error while symlinking {} to {}: {}".format(
                     remote_path, link_destination, e))
 
-    def node_check_for_upload_create(self, relative_path, f):
-        """Check if the given directory tree node has to be uploaded/created on the remote folder."""
-        if not relative_path:
-            # we're at the root of the shared directory tree
-            relative_path = str()
+    def _local_entries(self, relative_path):
+        """Return the lstat of each node of the local directory at relative_path, by name."""
+        local_path = path_join(self.local_path, relative_path)
+        if hasattr(os, "scandir"):  # Python >= 3.5, it saves a stat where it can
+            it = os.scandir(local_path)
+            try:
+                nodes = [(e.name, functools.partial(e.stat, follow_symlinks=False)) for e in it]
+            finally:
+                if hasattr(it, "close"):
+                    it.close()
+        else:
+            # their names are decoded as the remote ones are, whatever the type of local_path
+            nodes = [(fsdecode(f), functools.partial(os.lstat, path_join(local_path, f)))
+                     for f in os.listdir(local_path)]
+            if paramiko.py3compat.PY2:
+                nodes = [node for node in nodes if self._decoded(relative_path, node[0])]
+
+        entries = {}
+        for f, lstat in nodes:
+            try:
+                entries[f] = lstat()
+            except OSError as e:
+                """A little background here.
+                Sometimes, in big clusters configurations (mail, etc.),
+                files could disappear or be moved, suddenly.
+                There's nothing to do about it,
+                system should be stopped before doing backups.
+                Anyway, we log it, and skip it.
+                """
+                self.logger.error("error while checking {}: {}".format(path_join(relative_path, f), e))
+        return entries
+
+    def _remote_entries(self, relative_path, sftp=None):
+        """Yield the attributes of each node of the remote directory at relative_path (of the previous release).
+
+        The listing is streamed, with several READDIR requests in flight (see `_SFTPClient.listdir_iter`)."""
+        sftp = sftp or self.sftp
+        root = self._previous_release or self.remote_path
+        entries = sftp.listdir_iter(path_join(root, relative_path), read_aheads=self.listing_requests)
+        if paramiko.py3compat.PY2:
+            return (r_st for r_st in entries if self._decoded(relative_path, r_st.filename))
+        return entries
+
+    def _decoded(self, relative_path, name):
+        """Tell whether name has been decoded (see `fsdecode`), and log those which can't be, on Python 2.x.
+
+        Without surrogate escapes, they couldn't be compared with the others: they are skipped."""
+        if not isinstance(name, bytes):
+            return True
+        self.logger.error("Skipping {}, whose name can't be decoded on Python 2.x.".format(
+            printable(path_join(relative_path, name))))
+        return False
 
-        # the (absolute) local address of f.
-        local_path = path_join(self.local_path, relative_path, f)
-        try:
-            l_st = os.lstat(local_path)
-        except OSError as e:
-            """A little background here.
-            Sometimes, in big clusters configurations (mail, etc.),
-            files could disappear or be moved, suddenly.
-            There's nothing to do about it,
-            system should be stopped before doing backups.
-            Anyway, we log it, and skip it.
-            """
-            self.logger.error("error while checking {}: {}".format(relative_path, e))
-            return
+    def _symlink_destination(self, local_path):
+        """Return where the remote copy of the local link at local_path should point to.
+
+        Return None if the link has to be left as it is."""
+        # read the local link
+        local_link = fsdecode(os.readlink(local_path))
+        absolute_local_link = os.path.realpath(local_link)
+
+        # is it absolute?
+        is_absolute = os.path.isabs(local_link)
+        # and does it point inside the shared directory?
+        # add trailing slash (security)
+        trailing_local_path = path_join(self.local_path, '')
+        if isinstance(local_link, bytes):  # Python 2.x, a destination which can't be decoded
+            trailing_local_path = fsencode(trailing_local_path)
+        relpath = os.path.commonprefix(
+            [absolute_local_link,
+             trailing_local_path]
+        ) == trailing_local_path
+
+        if relpath:
+            relative_link = absolute_local_link[len(trailing_local_path):]
+        else:
+            relative_link = None
+
+        """
+        # Refactor them all, be efficient!
+
+        # Case A: absolute link pointing outside shared directory
+        #   (we can only update the remote part)
+        if is_absolute and not relpath:
+            self.create_update_symlink(local_link, remote_path)
+
+        # Case B: absolute link pointing inside shared directory
+        #   (we can leave it as it is or fix the prefix to match the one of the remote server)
+        elif is_absolute and relpath:
+            if self.fix_symlinks:
+                self.create_update_symlink(
+                    join(
+                        self.remote_path,
+                        relative_link,
+                    ),
+                    remote_path
+                )
+            else:
+                self.create_update_symlink(local_link, remote_path)
+
+        # Case C: relative link pointing outside shared directory
+        #   (all we can do is try to make the link anyway)
+        elif not is_absolute and not relpath:
+            self.create_update_symlink(local_link, remote_path)
+
+        # Case D: relative link pointing inside shared directory
+        #   (we preserve the relativity and link it!)
+        elif not is_absolute and relpath:
+            self.create_update_symlink(local_link, remote_path)
+        """
+
+        if is_absolute and relpath:
+            if self.fix_symlinks:
+                return path_join(self.remote_path, relative_link)
+            return None
+
+        return local_link
+
+    def _plan_node(self, plan, directories, relative_path, l_st, r_st, sftp=None):
+        """Add to plan what is needed to sync the local node at relative_path.
+
+        r_st are the attributes of its remote correspondent (None if missing).
+        Directories are appended to directories, to be scanned later on.
+        While a release is deployed, r_st are those of the previous one, the new one being empty:
+        its unchanged files are linked from there."""
+        # the (absolute) local address of the node.
+        local_path = self._local_prefix + relative_path
 
         if local_path in self.exclude_list:
             self.logger.info("Skipping excluded file %s.", local_path)
             return
 
-        # the (absolute) remote address of f.
-        remote_path = path_join(self.remote_path, relative_path, f)
+        if r_st is not None and S_IFMT(r_st.st_mode) != S_IFMT(l_st.st_mode):
+            # only happens if we can't delete the remote one
+            self.logger.warning(
+                "Skipping %s, a different kind of file exists on remote side.", local_path)
+            return
+
+        release = self._previous_release is not None
 
-        # First case: f is a directory
+        # First case: a directory
         if S_ISDIR(l_st.st_mode):
-            # we check if the folder exists on the remote side
-            # it has to be a folder, otherwise it would have already been
-            # deleted
+            if r_st is None or release:
+                plan.append(Action(MKDIR, relative_path, 0, l_st, None))
+
+            directories.append((
+                relative_path,
+                r_st is not None,
+                l_st if r_st is None or release or self._attrs_differ(l_st, r_st, self.chown) else None,
+            ))
+
+        # Second case: a symbolic link
+        elif S_ISLNK(l_st.st_mode):
+            destination = self._symlink_destination(local_path)
+            if destination is None:
+                return
+
+            if r_st is not None and not release:
+                try:
+                    if (sftp or self.sftp).readlink(path_join(self.remote_path, relative_path)) == destination:
+                        return
+                except (IOError, EOFError, paramiko.SSHException):
+                    pass  # made again, if the connection has been lost meanwhile
+
+            plan.append(Action(SYMLINK, relative_path, 0, l_st, destination))
+
+        # Third case: a regular file
+        elif S_ISREG(l_st.st_mode):
+            link_source = self._hard_link_source(relative_path, l_st)
+
+            if r_st is not None and not self._file_need_upload(l_st, r_st) and \
+                    not (release and self._attrs_differ(l_st, r_st, self.chown)):
+                self._dedupe_register(local_path, relative_path, l_st)
+                if release:  # a hard link shares the attributes, they must match already
+                    plan.append(Action(LINK, relative_path, l_st.st_size, l_st,
+                                       path_join(self._previous_release, relative_path)))
+            elif link_source:
+                plan.append(Action(LINK, relative_path, l_st.st_size, l_st, link_source))
+            else:  # or a copy, once the plan is complete (see `_dedupe_plan`)
+                plan.append(Action(UPLOAD, relative_path, l_st.st_size, l_st, None))
+
+        # Anything else.
+        else:
+            self.logger.warning("Skipping unsupported file %s.", local_path)
+
+    def _scan_directory(self, plan, directories, relative_path, remote_exists, l_st, sftp=None):
+        """Add to plan what is needed to sync the content of the directory at relative_path.
+
+        Its listing is compared with the remote one (if remote_exists), entry by entry as it streams in.
+        If l_st is given, or anything changes inside it, its attributes are synced too.
+
+        :return: The SFTP session used in the end (see `_retry`).
+        """
+        local_entries = None
+        if self._local_scanner is not None:
+            local_entries = self._local_scanner.take(relative_path)
+        if local_entries is None:
+            local_entries = self._local_entries(relative_path)
+            if self._local_scanner is not None:
+                self._local_scanner.add_children(relative_path, local_entries)
+
+        # the first of hard-linked (or identical) files must come first in the plan:
+        # each node is planned, and its actions added, at once
+        changed = [False]
+        prefix = path_join(relative_path, "")  # the path of each node is joined once, from there
+        symlinks = []  # they need a readlink, sent once the listing is over
+        seen = set()  # if the connection is lost, the listing starts over: they are skipped
+
+        def compare(sftp):
+            for r_st in self._remote_entries(relative_path, sftp):
+                f = r_st.filename
+                if f in seen:
+                    continue
+                seen.add(f)
+                local_st = local_entries.pop(f, None)
+                path = prefix + f
+                with self._scan_lock:
+                    planned = len(plan)
+                    # remote symlinks are never followed,
+                    # so that we can't delete files outside the shared directory
+                    if local_st is None or S_IFMT(local_st.st_mode) != S_IFMT(r_st.st_mode):
+                        if self._previous_release is not None:
+                            r_st = None  # left behind, in the previous release
+                        elif self.delete:
+                            plan.append(Action(DELETE, path, 0, r_st, None))
+                            r_st = None
+                    if local_st is not None:
+                        if r_st is not None and S_ISLNK(local_st.st_mode) and S_ISLNK(r_st.st_mode):
+                            symlinks.append((path, local_st, r_st))
+                        else:
+                            self._plan_node(plan, directories, path, local_st, r_st, sftp)
+                    changed[0] = changed[0] or len(plan) > planned
+
+        if remote_exists:
+            sftp = self._retry(compare, sftp)
+
+        with self._scan_lock:
+            planned = len(plan)
+            for path, local_st, r_st in symlinks:
+                self._plan_node(plan, directories, path, local_st, r_st, sftp)
+            for f, local_st in local_entries.items():
+                self._plan_node(plan, directories, prefix + f, local_st, None, sftp)
+            changed = changed[0] or len(plan) > planned
+
+            if relative_path and (l_st is not None or changed):
+                plan.append(Action(SETSTAT, relative_path, 0, l_st or os.lstat(
+                    path_join(self.local_path, relative_path)), None))
+
+        return sftp
+
+    def scan(self, remote_exists=True):
+        """Compare the local and the remote trees and return the sync plan.
+
+        The trees are walked breadth-first, with several remote directories being listed at the same time,
+        each one on its own SFTP channel (spread over the SSH connections).
+        Each listing is compared with the local one as soon as it arrives,
+        which may have been listed ahead by the local threads.
+        Nothing is changed on the remote side."""
+        if self.local_threads:
+            self._local_scanner = LocalScanner(
+                self._local_entries,
+                lambda relative_path: path_join(self.local_path, relative_path) in self.exclude_list,
+                self.local_threads,
+            )
+            self._local_scanner.add("")
+        try:
+            plan = self._scan_tree(remote_exists)
+        finally:
+            if self._local_scanner is not None:
+                self._local_scanner.stop()
+                self._local_scanner = None
+        self._dedupe_plan(plan)
+        return plan
+
+    def _scan_tree(self, remote_exists):
+        """Return the sync plan of the whole tree (see `scan`)."""
+        plan = []
+        directories = deque([("", remote_exists, None)])
+
+        sessions = max(self.scan_channels, len(self.transports))
+        if sessions == 1:
+            while directories:
+                self._scan_directory(plan, directories, *directories.popleft())
+            return plan
+
+        pending = threading.Condition()
+        busy = [0]  # directories being scanned
+        errors = []
+
+        def scan_directories(i):
+            # the other sessions are opened once there is something to do
+            sftp = self.sftp if i == 0 else None
             try:
-                self.sftp.stat(remote_path)
-            except IOError:  # it doesn't exist yet on remote side
-                self.sftp.mkdir(remote_path)
+                while True:
+                    with pending:
+                        while not directories and busy[0] and not errors:
+                            pending.wait()
+                        if not directories or errors:
+                            return
+                        directory = directories.popleft()
+                        busy[0] += 1
+
+                    if sftp is None:
+                        try:
+                            sftp = _SFTPClient.from_transport(self.transports[i % len(self.transports)])
+                        except paramiko.SSHException as e:
+                            # e.g. the server's limit of sessions per connection, leave it to the others
+                            self.logger.debug("Can't open SFTP channel {} to scan: {}".format(i, e))
+                            with pending:
+                                directories.appendleft(directory)
+                                busy[0] -= 1
+                                pending.notify_all()
+                            return
+
+                    found = []
+                    try:
+                        sftp = self._scan_directory(plan, found, *directory, sftp=sftp)
+                    except Exception as e:
+                        errors.append(e)
+
+                    with pending:
+                        directories.extend(found)
+                        busy[0] -= 1
+                        pending.notify_all()
+            finally:
+                if sftp is not None and i:
+                    sftp.close()
+
+        threads = [
+            threading.Thread(
+                target=scan_directories, args=(i,),
+                name="{}-scan-{}".format(threading.current_thread().name, i),
+            )
+            for i in range(sessions)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
 
-            self._match_modes(remote_path, l_st)
+        if errors:
+            raise errors[0]
+        return plan
 
-            # now, we should traverse f too (recursion magic!)
-            self.check_for_upload_create(path_join(relative_path, f))
+    def plan_path(self, relative_path, recursive=False):
+        """Return the plan syncing a single node of the tree, given its path relative to the shared directory.
 
-        # Second case: f is a symbolic link
-        elif S_ISLNK(l_st.st_mode):
-            # read the local link
-            local_link = os.readlink(local_path)
-            absolute_local_link = os.path.realpath(local_link)
-
-            # is it absolute?
-            is_absolute = local_link.startswith("/")
-            # and does it point inside the shared directory?
-            # add trailing slash (security)
-            trailing_local_path = path_join(self.local_path, '')
-            relpath = os.path.commonprefix(
-                [absolute_local_link,
-                 trailing_local_path]
-            ) == trailing_local_path
-
-            if relpath:
-                relative_link = absolute_local_link[len(trailing_local_path):]
-            else:
-                relative_link = None
+        Directories' content is synced only if recursive is True."""
+        if not relative_path:  # the whole tree
+            return self.scan()
 
-            """
-            # Refactor them all, be efficient!
+        plan = []
+        if self._is_excluded(relative_path):
+            self.logger.info("Skipping excluded file %s.", relative_path)
+            return plan
 
-            # Case A: absolute link pointing outside shared directory
-            #   (we can only update the remote part)
-            if is_absolute and not relpath:
-                self.create_update_symlink(local_link, remote_path)
+        local_path = path_join(self.local_path, relative_path)
+        remote_path = path_join(self.remote_path, relative_path)
 
-            # Case B: absolute link pointing inside shared directory
-            #   (we can leave it as it is or fix the prefix to match the one of the remote server)
-            elif is_absolute and relpath:
-                if self.fix_symlinks:
-                    self.create_update_symlink(
-                        join(
-                            self.remote_path,
-                            relative_link,
-                        ),
-                        remote_path
-                    )
-                else:
-                    self.create_update_symlink(local_link, remote_path)
+        try:
+            r_st = self.sftp.lstat(remote_path)
+        except IOError:
+            if self._connection_lost(self.sftp):
+                raise
+            r_st = None
 
-            # Case C: relative link pointing outside shared directory
-            #   (all we can do is try to make the link anyway)
-            elif not is_absolute and not relpath:
-                self.create_update_symlink(local_link, remote_path)
+        if r_st is not None and self.delete and self._must_be_deleted(local_path, r_st):
+            plan.append(Action(DELETE, relative_path, 0, r_st, None))
+            r_st = None
 
-            # Case D: relative link pointing inside shared directory
-            #   (we preserve the relativity and link it!)
-            elif not is_absolute and relpath:
-                self.create_update_symlink(local_link, remote_path)
-            """
+        try:
+            l_st = os.lstat(local_path)
+        except OSError:  # it doesn't exist anymore
+            return plan
+
+        directories = []
+        self._plan_node(plan, directories, relative_path, l_st, r_st)
+        while directories:
+            relative_path, remote_exists, l_st = directories.pop()
+            if recursive:
+                self._scan_directory(plan, directories, relative_path, remote_exists, l_st)
+            elif l_st is not None:
+                plan.append(Action(SETSTAT, relative_path, 0, l_st, None))
+
+        self._dedupe_plan(plan)
+        return plan
+
+    def plan_paths(self, paths):
+        """Return the plan syncing the given nodes of the tree (not their content) and their parent directories.
+
+        What doesn't exist locally anymore is deleted, with its content."""
+        nodes = set()
+        for relative_path in paths:
+            while relative_path and relative_path not in nodes:
+                nodes.add(relative_path)
+                relative_path = os.path.dirname(relative_path)
+
+        plan = []
+        gone = set()  # deleted with their content
+        for relative_path in sorted(nodes):  # parents first
+            if os.path.dirname(relative_path) in gone:
+                gone.add(relative_path)
+                continue
+            plan.extend(self.plan_path(relative_path))
+            if not os.path.lexists(path_join(self.local_path, relative_path)):
+                gone.add(relative_path)
+        return plan
+
+    def git_plan(self, remote_exists=True):
+        """Return the plan syncing what changed since the last deployed commit, and the state to record once done.
+
+        The local directory is (in) a git working tree: the changed paths are those of
+        `git diff --name-status -M` between the deployed commit and the working tree,
+        the untracked ones and those which differed from the deployed commit when it was deployed.
+        The state (HEAD and the paths differing from it) is kept in GIT_STATE_FILE, in the remote directory.
+        If it's missing or unknown to the repository, the whole tree is scanned instead."""
+        try:
+            head = git_output(self.local_path, "rev-parse", "HEAD").strip()
+            dirty = set(git_output(self.local_path, "diff", "--name-only", "-z", "--relative", "HEAD").split("\0"))
+            dirty.update(git_output(self.local_path, "ls-files", "-z", "--others", "--exclude-standard").split("\0"))
+            dirty.discard("")
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.logger.warning("Can't read the git repository ({}), scanning the whole tree.".format(e))
+            return self.scan(remote_exists), None
+
+        state = {"commit": head, "dirty": sorted(dirty)}
+        deployed = self._read_git_state() if remote_exists else None
+        if deployed is not None:
+            try:
+                git_output(self.local_path, "cat-file", "-e", deployed["commit"] + "^{commit}")
+            except (OSError, subprocess.CalledProcessError):
+                self.logger.warning("The deployed commit %s isn't in the repository.", deployed["commit"])
+                deployed = None
+        if deployed is None:
+            self.logger.info("No deployed commit known, scanning the whole tree.")
+            return self.scan(remote_exists), state
+
+        paths = parse_name_status(git_output(
+            self.local_path, "diff", "--name-status", "-M", "-z", "--relative", deployed["commit"]))
+        paths.update(dirty)
+        paths.update(deployed["dirty"])
+        self.logger.info("%d path(s) changed since commit %s.", len(paths), deployed["commit"])
+        return self.plan_paths(paths), state
+
+    def _read_git_state(self):
+        """Return the git state recorded in the remote directory, None if there isn't a valid one."""
+        try:
+            with self.sftp.open(path_join(self.remote_path, GIT_STATE_FILE), 'r') as f:
+                state = json.loads(f.read().decode("utf-8"))
+            return {"commit": state["commit"], "dirty": list(state["dirty"])}
+        except (IOError, ValueError, TypeError, KeyError):
+            return None
+
+    def _write_git_state(self, state):
+        """Record the git state in the remote directory, once the sync is complete."""
+        with self.sftp.open(path_join(self.remote_path, GIT_STATE_FILE), 'w') as f:
+            f.write(json.dumps(state).encode("utf-8"))
+
+    def _chunk_path(self, chunk):
+        """Return the remote path a chunk is written to: the temporary one of its file, in atomic mode."""
+        return self._chunk_targets.get(chunk.action.path) or path_join(self.remote_path, chunk.action.path)
+
+    def _upload_chunk(self, chunk, sftp):
+        """Write a byte range of a local file at its offset in the (preallocated) remote file."""
+        local_path = path_join(self.local_path, chunk.action.path)
+        remote_path = self._chunk_path(chunk)
+
+        with io.open(local_path, 'rb', buffering=0) as lf:
+            with self._open_for_writing(sftp, remote_path, 'r+b') as rf:
+                rf.seek(chunk.offset)
+                self._send_sparse(lf, rf, chunk.offset, chunk.length)
+                self._wait_writes(rf)
+
+        if self.verify:
+            self._verify_chunk(chunk, sftp)
+
+    def _verify_chunk(self, chunk, sftp):
+        """Compare the hashes of the blocks of a chunk, computed by the server, with the local ones.
+
+        Raise IOError if they differ. The check is skipped if the server can't do it."""
+        local_path = path_join(self.local_path, chunk.action.path)
+        remote_path = self._chunk_path(chunk)
 
-            if is_absolute and relpath:
-                if self.fix_symlinks:
-                    self.create_update_symlink(
-                        path_join(
-                            self.remote_path,
-                            relative_link,
-                        ),
-                        remote_path
-                    )
-            else:
-                self.create_update_symlink(local_link, remote_path)
+        try:
+            with sftp.open(remote_path, 'rb') as rf:
+                _, msg = sftp._request(
+                    CMD_EXTENDED, "check-file", rf.handle, "sha256,sha1,md5",
+                    paramiko.py3compat.long(chunk.offset), paramiko.py3compat.long(chunk.length),
+                    VERIFY_BLOCK_SIZE,
+                )
+        except IOError as e:
+            if self.verify:
+                self.verify = False
+                self.logger.warning("The server can't hash files ({}), uploads won't be checked.".format(e))
+            return
 
-        # Third case: regular file
-        elif S_ISREG(l_st.st_mode):
+        msg.get_text()  # extension
+        algorithm = msg.get_text()
+        remote_hashes = msg.get_remainder()
+
+        local_hashes = b""
+        with open(local_path, 'rb') as lf:
+            lf.seek(chunk.offset)
+            left = chunk.length
+            while left > 0:
+                block = lf.read(min(left, VERIFY_BLOCK_SIZE))
+                local_hashes += hashlib.new(algorithm, block).digest()
+                left -= len(block)
+
+        if local_hashes != remote_hashes:
+            raise IOError("{} is corrupt, bytes {}-{} differ".format(
+                remote_path, chunk.offset, chunk.offset + chunk.length))
+
+    def _complete_chunked(self, action, sftp):
+        """Set the attributes of a file uploaded in chunks, and rename it into place in atomic mode."""
+        remote_path = path_join(self.remote_path, action.path)
+        temp_path = self._chunk_targets.get(action.path)
+        self._match_modes(temp_path or remote_path, action.st, sftp)
+        if temp_path:
+            sftp.posix_rename(temp_path, remote_path)
+            del self._chunk_targets[action.path]
+
+    def _chunked_completed(self, action, sftp):
+        """Tell whether a file uploaded in chunks has been renamed into place (see `_complete_chunked`)."""
+        temp_path = self._chunk_targets.get(action.path)
+        if temp_path is None or self._exists(sftp, temp_path):
+            return False
+        del self._chunk_targets[action.path]
+        return True
+
+    @staticmethod
+    def _preallocate(sftp, remote_path, size):
+        """Create the remote file at remote_path, size bytes long."""
+        with sftp.open(remote_path, 'wb') as f:
+            f.truncate(size)
+
+    def _upload_batch(self, batch, sftp):
+        """Upload the files of a batch of upload actions, one after the other.
+
+        :return: The SFTP session used in the end (see `_retry`).
+        """
+        for action in batch:
+            sftp = self._retry(lambda sftp: self.file_upload(
+                path_join(self.local_path, action.path),
+                path_join(self.remote_path, action.path),
+                action.st, sftp,
+            ), sftp)
+            self._done(action)
+        return sftp
+
+    def _upload_all(self, uploads):
+        """Perform upload actions over several channels.
+
+        Huge files are split into chunks, uploaded at the same time by several channels.
+        Large files are started first, each one on its own channel,
+        while small files are uploaded in batches by the other channels."""
+        jobs = deque()
+        chunks_left = {}  # path of chunked files -> chunks still being uploaded
+
+        for action in sorted(uploads, key=lambda a: a.size, reverse=True):
+            if self.chunked_size and action.size > self.chunked_size:
+                # preallocate the remote file: the chunks are written in place
+                remote_path = path_join(self.remote_path, action.path)
+                if self._atomic_uploads():
+                    remote_path = self._chunk_targets[action.path] = self._temp_path(remote_path)
+                self._retry(lambda sftp: self._preallocate(sftp, remote_path, action.size))
+                offsets = range(0, action.size, CHUNK_SIZE)
+                jobs.extend(Chunk(action, o, min(CHUNK_SIZE, action.size - o)) for o in offsets)
+                chunks_left[action.path] = len(offsets)
+            elif action.size >= LARGE_FILE_SIZE:
+                jobs.append([action])
+
+        batch, batch_size = [], 0
+        for action in sorted(uploads, key=lambda a: a.path):
+            if action.size >= LARGE_FILE_SIZE or action.path in chunks_left:
+                continue
+            batch.append(action)
+            batch_size += action.size
+            if len(batch) >= SMALL_FILES_BATCH or batch_size >= LARGE_FILE_SIZE:
+                jobs.append(batch)
+                batch, batch_size = [], 0
+        if batch:
+            jobs.append(batch)
+
+        # at least a channel per connection
+        channels = max(self.channels, len(self.transports))
+        if self.adaptive:
+            channels = max(channels, ADAPTIVE_MAX_CHANNELS)
+        # and, in adaptive mode, one more for the probe of the controller (see `_run_upload_jobs`)
+        clients = self._open_clients(min(channels, len(jobs)) + (1 if self.adaptive else 0))
+        lock = threading.Lock()
+
+        if self.read_ahead:
+            # in the order they are uploaded: with several channels, batches are taken from the end of the queue
+            self._read_ahead = ReadAhead([
+                (path_join(self.local_path, a.path), a.size)
+                for job in (jobs if len(clients) == 1 else reversed(jobs))
+                if not isinstance(job, Chunk) and job[0].size < LARGE_FILE_SIZE
+                for a in job
+            ], self.read_ahead)
+
+        try:
+            self._run_upload_jobs(jobs, clients, lock, chunks_left)
+        finally:
+            if self._read_ahead is not None:
+                self._read_ahead.stop()
+                self._read_ahead = None
+            for sftp in clients[1:]:
+                sftp.close()
+            # those of the files left incomplete
+            for temp_path in self._chunk_targets.values():
+                self._discard(self.sftp, temp_path)
+            self._chunk_targets.clear()
+
+    def _run_upload_jobs(self, jobs, clients, lock, chunks_left):
+        """Upload the jobs of the queue, using the given SFTP sessions.
+
+        In adaptive mode, the last one is kept for the probe of the controller, if there are several:
+        its round trips mustn't wait behind the uploads' ones."""
+        probe = None
+        if self.adaptive and len(clients) > 1:
+            probe, clients = clients[-1], clients[:-1]
+
+        def upload_job(job, sftp):
+            # return the session to go on with, it's replaced if the connection is lost
+            if not isinstance(job, Chunk):
+                return self._upload_batch(job, sftp)
+
+            sftp = self._retry(functools.partial(self._upload_chunk, job), sftp)
+            with lock:
+                chunks_left[job.action.path] -= 1
+                if chunks_left[job.action.path]:
+                    return sftp
+
+            # the last chunk completes the file
+            sftp = self._retry(functools.partial(self._complete_chunked, job.action), sftp,
+                               done=functools.partial(self._chunked_completed, job.action))
+            self._count(UPLOAD, job.action.size)
+            self._done(job.action)
+            return sftp
+
+        if len(clients) == 1:
+            for job in jobs:
+                upload_job(job, self.sftp)
+            return
+
+        errors = []
+
+        def upload_jobs(i, sftp, large_first):
+            session = sftp
+            try:
+                while not errors:
+                    if self._controller is not None and not self._controller.admits(i):
+                        if not jobs:
+                            return
+                        continue
+                    with lock:
+                        if not jobs:
+                            return
+                        job = jobs.popleft() if large_first else jobs.pop()
+                    session = upload_job(job, session)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if session is not sftp and session is not self.sftp:
+                    session.close()  # opened after a lost connection
+
+        if probe is not None:
+            self._controller = ConcurrencyController(
+                len(clients), functools.partial(probe.stat, self.remote_path),
+                request_size=self.capabilities.write_length)
+            self._controller.start()
+
+        # half of the channels start from the largest files, the other half from the small ones
+        # (the first ones, if the controller allows just a few of them)
+        threads = [
+            threading.Thread(
+                target=upload_jobs, args=(i, sftp, i % 2 == 0 if self.adaptive else i < len(clients) // 2 or i == 0),
+                name="{}-upload-{}".format(threading.current_thread().name, i),
+            )
+            for i, sftp in enumerate(clients)
+        ]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            if self._controller is not None:
+                self._controller.stop()
+                self.stats["channels"] = max(self.stats["channels"], self._controller.channels)
+                self.stats["pipeline depth"] = max(self.stats["pipeline depth"], self._controller.depth)
+                if self._controller.rtt is not None:
+                    self.stats["rtt ms"] = max(self.stats["rtt ms"], int(self._controller.rtt * 1000))
+                self._controller = None
+
+        if errors:
+            raise errors[0]
+
+    def _reconnect_forked(self):
+        """Open new SSH connections in a forked process, as many as the parent's ones.
+
+        The parent's connections can't be shared: their objects are kept alive,
+        but never used again, lest they talk over the parent's sockets."""
+        self._parent_connections = (self.sftp, self.transports, self._agent)
+
+        if self._agent is not None:
+            # the same goes for the connection to the agent
+            username, password, pkey = self._auth
+            self._agent = paramiko.Agent()
+            pkey = next(k for k in self._agent.get_keys() if k.asbytes() == pkey.asbytes())
+            self._auth = (username, password, pkey)
+
+        self.transports = []
+        for _ in self._parent_connections[1]:
+            self.transports.append(self._open_transport())
+        self.transport = self.transports[0]
+        self.sftp = _SFTPClient.from_transport(self.transport)
+
+    def _upload_processes(self, uploads):
+        """Perform upload actions, split into shards of about the same size, each one by a forked process.
+
+        Their statistics are merged into these ones.
+        Exit if any of them failed, with the worst exit status."""
+        shards = shard_by_size(uploads, self.processes)
+        workers = {}  # pid -> pipe reading its result
+
+        for shard in shards:
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:  # the worker
+                os.close(r)
+                status = 0
+                try:
+                    if self.bandwidth is not None:
+                        self.bandwidth = self.bandwidth.split(len(shards))
+                    self.stats = Counter()
+                    self._reconnect_forked()
+                    self._upload_all(shard)
+                    self.close()
+                except SystemExit as e:
+                    status = e.code if isinstance(e.code, int) else 1
+                except BaseException as e:
+                    self.logger.error("Error while uploading: {}".format(e))
+                    status = 1
+
+                with os.fdopen(w, 'w') as f:
+                    json.dump({"status": status, "stats": self.stats}, f)
+                os._exit(status)
+
+            os.close(w)
+            workers[pid] = r
+
+        failures = []
+        for pid, r in workers.items():
+            with os.fdopen(r) as f:
+                data = f.read()
+            _, status = os.waitpid(pid, 0)
             try:
-                r_st = self.sftp.lstat(remote_path)
-                if self._file_need_upload(l_st, r_st):
-                    self.file_upload(local_path, remote_path, l_st)
+                result = json.loads(data)
+            except ValueError:  # killed before telling
+                result = {"status": os.WEXITSTATUS(status) or 1, "stats": {}}
+
+            for k, v in result["stats"].items():
+                # the values the adaptive mode settled on aren't summed
+                self.stats[k] = max(self.stats[k], v) if k in ADAPTIVE_STATS else self.stats[k] + v
+            if result["status"]:
+                failures.append(result["status"])
+
+        if failures:
+            self.logger.error("{} of {} upload processes failed. Exiting.".format(len(failures), len(workers)))
+            sys.exit(max(failures))
+
+    def execute(self, plan):
+        """Perform the actions of a sync plan.
+
+        Deletions come first, then directories are created and the files uploaded.
+        Links and copies of uploaded files follow, while directories' attributes are set last.
+        Each action is retried if the connection is lost meanwhile (see `_retry`)."""
+        for action in plan:
+            if action.kind == DELETE:
+                self._retry(lambda sftp: self.remote_delete(path_join(self.remote_path, action.path), action.st))
+                self._count(DELETE)
+                self._done(action)
+
+        # parents before their children
+        for action in sorted((a for a in plan if a.kind == MKDIR), key=lambda a: a.path):
+            remote_path = path_join(self.remote_path, action.path)
+            self._retry(lambda sftp: sftp.mkdir(remote_path),
+                        done=lambda sftp: self._exists(sftp, remote_path, directory=True))
+            self._count(MKDIR)
+            self._done(action)
+
+        uploads = [a for a in plan if a.kind == UPLOAD]
+        if self.processes > 1 and len(uploads) > 1 and self._auth is not None:
+            self._upload_processes(uploads)
+        else:
+            self._upload_all(uploads)
+
+        linked = set()
+        if self.releases and self._remote_hardlink:
+            self._retry(functools.partial(self._link_release, [a for a in plan if a.kind == LINK], linked))
+
+        for action in plan:
+            if action.kind in (SYMLINK, LINK, COPY) and action.path not in linked:
+                self._retry(functools.partial(self._link, action))
+                self._done(action)
+
+        # children before their parents, once their content changed
+        for action in sorted((a for a in plan if a.kind == SETSTAT), key=lambda a: a.path, reverse=True):
+            self._retry(lambda sftp: self._match_modes(path_join(self.remote_path, action.path), action.st, sftp))
+            self._count(SETSTAT)
+            self._done(action)
+
+    def _link_release(self, actions, linked, sftp):
+        """Create the hard links of a new release, with up to SEED_REQUESTS requests in flight.
+
+        Nothing is there yet, so nothing has to be removed first.
+        The paths of the links created are added to linked, the others are left to `_link`."""
+        replies = _Replies()
+        pending = deque()
+
+        def settle(action, num):
+            try:
+                replies.wait(sftp, num)
             except IOError as e:
-                if e.errno == errno.ENOENT:
-                    self.file_upload(local_path, remote_path, l_st)
+                if self._connection_lost(sftp):
+                    raise
+                # unless it was created before the connection was lost, with the reply
+                if not self._same_file(sftp, path_join(self.remote_path, action.source),
+                                       path_join(self.remote_path, action.path)):
+                    if self._remote_hardlink:
+                        self.logger.warning(
+                            "Server can't create hard links ({}). "
+                            "Copying or uploading the files instead.".format(e)
+                        )
+                        self._remote_hardlink = False
+                    return
+            linked.add(action.path)
+            self._count(LINK)
+            self._done(action)
+
+        for action in actions:
+            if action.path in linked:
+                continue  # before the connection was lost
+            if len(pending) >= SEED_REQUESTS:
+                settle(*pending.popleft())
+            if not self._remote_hardlink:
+                break
+            pending.append((action, sftp._async_request(
+                replies, CMD_EXTENDED, "hardlink@openssh.com",
+                path_join(self.remote_path, action.source), path_join(self.remote_path, action.path),
+            )))
+        while pending:
+            settle(*pending.popleft())
+
+    def _link(self, action, sftp):
+        """Perform a symlink, link or copy action (links fall back to a copy, copies to an upload)."""
+        local_path = path_join(self.local_path, action.path)
+        remote_path = path_join(self.remote_path, action.path)
+
+        if action.kind == SYMLINK:
+            self.create_update_symlink(action.source, remote_path, replace=not self.releases)
+            self._count(SYMLINK)
+        elif action.kind == LINK:
+            source = path_join(self.remote_path, action.source)
+            if self.remote_hardlink(source, remote_path):
+                self._count(LINK)
+            elif (self._remote_copy_data or self._remote_cp) and self.remote_copy(source, remote_path):
+                self._match_modes(remote_path, action.st, sftp)
+                self._count(COPY)
+            else:
+                self.file_upload(local_path, remote_path, action.st, sftp)
+        elif action.kind == COPY:
+            if self.remote_copy(path_join(self.remote_path, action.source), remote_path):
+                self._match_modes(remote_path, action.st, sftp)
+                self._count(COPY)
+            else:
+                self.file_upload(local_path, remote_path, action.st, sftp)
+
+    def report(self):
+        """Return a summary of the statistics of the sync."""
+        return (
+            "{upload} files uploaded ({bytes} bytes), {link} linked, {copy} copied, "
+            "{symlink} symbolic links, {mkdir} directories created, {delete} deleted."
+        ).format(**{k: self.stats[k] for k in ("upload", "bytes", "link", "copy", "symlink", "mkdir", "delete")}) + (
+            " Settled on {} channels, {} write requests in flight each (round-trip time: {} ms).".format(
+                *(self.stats[k] for k in ADAPTIVE_STATS)) if self.stats["channels"] else ""
+        )
 
-        # Anything else.
-        else:
-            self.logger.warning("Skipping unsupported file %s.", local_path)
+    def print_plan(self, plan, as_json=False, out=None):
+        """Print a sync plan, one action per line or as a JSON list."""
+        out = out or sys.stdout
+
+        if as_json:
+            json.dump([
+                {
+                    "action": a.kind,
+                    "path": a.path,
+                    "size": a.size,
+                    "mode": S_IMODE(a.st.st_mode),
+                    "mtime": int(a.st.st_mtime) if a.st.st_mtime is not None else None,
+                    "source": a.source,
+                }
+                for a in plan
+            ], out, indent=1)
+            print(file=out)
+            return
 
-    def check_for_upload_create(self, relative_path=None):
-        """Traverse the relative_path tree and check for files that need to be uploaded/created.
+        for a in plan:
+            if a.kind in (UPLOAD, LINK, COPY):
+                details = " ({} bytes)".format(a.size) if a.kind == UPLOAD else " <- {}".format(printable(a.source))
+            elif a.kind == SYMLINK:
+                details = " -> {}".format(printable(a.source))
+            else:
+                details = ""
+            print("{:<8} {}{}".format(a.kind, printable(a.path), details), file=out)
+
+        print("{} actions, {} bytes to upload.".format(
+            len(plan), sum(a.size for a in plan if a.kind == UPLOAD)), file=out)
+
+    def sync_path(self, relative_path, recursive=False):
+        """Sync a single node of the tree, given its path relative to the shared directory.
+
+        Directories' content is synced only if recursive is True."""
+        self.execute(self.plan_path(relative_path, recursive))
+
+    def sync_paths(self, changes):
+        """Sync the given nodes of the tree.
+
+        changes maps relative paths to True if their whole subtree has to be synced.
+        Return False if the connection has been lost, and couldn't be opened again (see `_retry`)."""
+        plan = []
+        for relative_path in sorted(changes):
+            # already synced with one of its parents?
+            parent = os.path.dirname(relative_path)
+            while parent and not changes.get(parent):
+                parent = os.path.dirname(parent)
+            if changes.get(parent) and parent != relative_path:
+                continue
 
-        Relativity here refers to the shared directory tree."""
-        for f in os.listdir(
-            path_join(
-                self.local_path, relative_path) if relative_path else self.local_path
-        ):
-            self.node_check_for_upload_create(relative_path, f)
+            try:
+                self._retry(lambda sftp: plan.extend(self.plan_path(relative_path, changes[relative_path])))
+            except (EnvironmentError, EOFError, paramiko.SSHException) as e:
+                if self._connection_lost(self.sftp):
+                    self.logger.error("connection lost while checking {}: {}".format(relative_path, e))
+                    return False
+                # it could have changed again in the meantime,
+                # its next events will tell.
+                self.logger.error("error while checking {}: {}".format(relative_path, e))
+
+        try:
+            self.execute(plan)
+        except (EnvironmentError, EOFError, paramiko.SSHException) as e:
+            self.logger.error("error while syncing: {}".format(e))
+            if self._connection_lost(self.sftp):
+                return False
+        return True
+
+    def watch(self, stop=None, debounce=0.2):
+        """Keep the remote folder in sync with the local changes, until stop (an Event) is set.
+
+        Changes are collected through inotify (or polling, where not available)
+        and merged when they come in bursts: only the affected paths are synced.
+        If the connection is lost (for longer than `_retry` waits), they're synced again later on,
+        waiting twice as long each time."""
+        self.transport.set_keepalive(30)
+
+        pending = {}  # the changes not synced yet
+        retry_at, delay = 0, RETRY_DELAY
+        watcher = create_watcher(self.local_path, self.logger)
+        try:
+            for changes in watch_changes(watcher, debounce):
+                if stop is not None and stop.is_set():
+                    break
+                for path, recursive in changes.items():
+                    pending[path] = pending.get(path, False) or recursive
+                if not pending or time.time() < retry_at:
+                    continue
+
+                self.logger.info("Syncing %d changed path(s).", len(pending))
+                if self.exclude_patterns:
+                    self.exclude_list = self._glob_exclude_patterns()
+                if self.sync_paths(pending):
+                    pending, delay = {}, RETRY_DELAY
+                else:
+                    self.logger.warning("Syncing the changes again in {:g} seconds.".format(delay))
+                    retry_at, delay = time.time() + delay, min(2 * delay, MAX_RETRY_DELAY)
+        finally:
+            watcher.close()
+
+    def close(self, transport=True):
+        """Close the SFTP session and the SSH connections.
+
+        If transport is False, the first one is kept open, and the agent its credentials may need."""
+        self.sftp.close()
+        for t in self.transports[1:]:
+            t.close()
+        if transport:
+            self.transport.close()
+            if self._agent:
+                self._agent.close()
+
+    def deploy_release(self, remote_exists=True):
+        """Sync into a new release directory, then switch the current symlink to it.
+
+        Releases are kept in remote_path/releases, named after the UTC time of their deployment.
+        The new one is compared with the one current points to: the unchanged files are hard-linked
+        (or copied) from there by the server, only the others are uploaded.
+        Nothing in use is changed until the switch, which is atomic if the server supports `posix-rename`.
+        The oldest releases are removed, to keep self.releases of them."""
+        releases = path_join(self.remote_path, RELEASES_DIR)
+        current = path_join(self.remote_path, CURRENT_LINK)
+
+        previous = None
+        try:
+            r_st = self.sftp.lstat(current) if remote_exists else None
+        except IOError:
+            r_st = None  # the first release
+        if r_st is not None and not S_ISLNK(r_st.st_mode):
+            self.logger.error("Remote %s exists and it isn't a symbolic link. Exiting.", current)
+            sys.exit(1)
+        if r_st is not None:
+            try:
+                # by absolute path, as it's linked from another directory
+                previous = self.sftp.normalize(path_join(self.remote_path, self.sftp.readlink(current)))
+                self.sftp.stat(previous)
+            except IOError as e:
+                self.logger.warning("Can't reach the current release ({}), uploading everything.".format(e))
+                previous = None
+
+        try:
+            names = set(self.sftp.listdir(releases))
+        except IOError:
+            names = set()
+            if not self.dry_run:
+                self.sftp.mkdir(releases)
+        name = stamp = time.strftime(RELEASE_NAME_FORMAT, time.gmtime())
+        i = 1
+        while name in names:  # more than one deployment in a second
+            name = "{}.{}".format(stamp, i)
+            i += 1
+
+        base = self.remote_path
+        self.remote_path = path_join(releases, name)
+        self._previous_release = previous
+        try:
+            plan = self.scan(previous is not None)
+            if self.dry_run:
+                self.print_plan(plan, as_json=self.plan_json)
+                return
+
+            self.logger.info("Deploying release %s%s.", name, " (from {})".format(previous) if previous else "")
+            self.sftp.mkdir(self.remote_path)
+            self.execute(plan)
+        finally:
+            self.remote_path = base
+            self._previous_release = None
+
+        self._switch_release(current, path_join(RELEASES_DIR, name))
+        self.logger.info(self.report())
+        self._prune_releases(releases, name)
+
+    def _switch_release(self, current, target):
+        """Point the current symlink to target, replacing it at once where the server can."""
+        if not self.capabilities.supports("posix-rename@openssh.com"):
+            self.logger.warning("Server can't replace %s atomically, it's missing for a moment.", current)
+            self.create_update_symlink(target, current)
+            return
+
+        temp_path = self._temp_path(current)
+        self.sftp.symlink(target, temp_path)
+        try:
+            self.sftp.posix_rename(temp_path, current)
+        except (IOError, EOFError, paramiko.SSHException):
+            self._discard(self.sftp, temp_path)
+            raise
+
+    def _prune_releases(self, releases, name):
+        """Remove the oldest releases, but the one just deployed, keeping self.releases of them."""
+        old = sorted(
+            (r_st for r_st in self.sftp.listdir_attr(releases)
+             if S_ISDIR(r_st.st_mode) and r_st.filename != name),
+            key=lambda r_st: r_st.filename,
+        )
+        for r_st in old[:max(len(old) - self.releases + 1, 0)]:
+            self.logger.info("Removing old release %s.", r_st.filename)
+            self.remote_delete(path_join(releases, r_st.filename), r_st)
 
     def run(self):
         """Run the sync.
@@ -598,10 +3035,15 @@ class SFTPClone(object):
         Confront the local and the remote directories and perform the needed changes."""
 
         # Check if remote path is present
+        remote_exists = True
         try:
             self.sftp.stat(self.remote_path)
         except FileNotFoundError as e:
-            if self.create_remote_directory:
+            if e.errno != errno.ENOENT:  # Python 2.x, where it's any IOError
+                raise
+            if self.create_remote_directory and self.dry_run:
+                remote_exists = False
+            elif self.create_remote_directory:
                 self.sftp.mkdir(self.remote_path)
                 self.logger.info(
                     "Created missing remote dir: '" + self.remote_path + "'")
@@ -611,14 +3053,47 @@ class SFTPClone(object):
                     "Add '-r' to create it if missing.")
                 sys.exit(1)
 
+        if self.releases:
+            self.deploy_release(remote_exists)
+            return
+
         try:
-            if self.delete:
-                # First check for items to be removed
-                self.check_for_deletion()
+            plan = None
+            git_state = None  # recorded once done, in git mode
+            if self.journal is not None and not self.dry_run:
+                plan = self.journal.resume()
+            if plan is not None:
+                self.logger.info("Resuming an interrupted sync, %d actions left.", len(plan))
+            else:
+                # First compare the trees
+                if self.paths is not None:
+                    plan = self.plan_paths(self.paths)
+                elif self.git:
+                    plan, git_state = self.git_plan(remote_exists)
+                else:
+                    plan = self.scan(remote_exists)
 
-            # Now scan local for items to upload/create
-            self.check_for_upload_create()
-        except FileNotFoundError:
+                if self.dry_run:
+                    self.print_plan(plan, as_json=self.plan_json)
+                    return
+
+                if self.journal is not None:
+                    self.journal.start(plan)
+
+            # Then change the remote one
+            completed = False
+            try:
+                self.execute(plan)
+                completed = True
+            finally:
+                if self.journal is not None:
+                    self.journal.close(completed)
+            if git_state is not None:
+                self._write_git_state(git_state)
+            self.logger.info(self.report())
+        except FileNotFoundError as e:
+            if e.errno != errno.ENOENT:  # Python 2.x, where it's any IOError
+                raise
             # If this happens, probably the remote folder doesn't exist.
             self.logger.error(
                 "Error while opening remote folder. Are you sure it does exist?")
@@ -634,6 +3109,7 @@ def create_parser():
     parser.add_argument(
         "path",
         type=str,
+        nargs="?",
         metavar="local-path",
         help="the path of the local folder",
     )
@@ -641,6 +3117,7 @@ def create_parser():
     parser.add_argument(
         "remote",
         type=str,
+        nargs="?",
         metavar="user[:password]@hostname:remote-path",
         help="the ssh-url ([user[:password]@]hostname:remote-path) of the remote folder. "
              "The hostname can be specified as a ssh_config's hostname too. "
@@ -744,6 +3221,181 @@ def create_parser():
         help="Create remote base directory if missing on remote"
     )
 
+    parser.add_argument(
+        "-H",
+        "--hard-links",
+        action="store_true",
+        help="preserve hard links on remote side"
+    )
+
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="upload identical files once and copy them on remote side"
+    )
+
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="keep syncing local changes after the first sync"
+    )
+
+    parser.add_argument(
+        "--daemon",
+        metavar="socket-path",
+        type=str,
+        help="keep connections open and run the sync jobs submitted on the socket-path Unix socket"
+    )
+
+    parser.add_argument(
+        "--control",
+        metavar="socket-path",
+        type=str,
+        help="submit the sync to the daemon listening on the socket-path Unix socket"
+    )
+
+    parser.add_argument(
+        "--channels",
+        metavar="N",
+        type=int,
+        help="number of SFTP channels uploading files in parallel (defaults to {})".format(DEFAULT_CHANNELS)
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print the actions needed to sync, without performing them"
+    )
+
+    parser.add_argument(
+        "--plan-json",
+        action="store_true",
+        help="print the actions needed to sync as JSON, without performing them"
+    )
+
+    parser.add_argument(
+        "--scan-channels",
+        metavar="N",
+        type=int,
+        help="number of SFTP channels listing remote directories in parallel (defaults to {})".format(
+            DEFAULT_SCAN_CHANNELS)
+    )
+
+    parser.add_argument(
+        "--in-place",
+        action="store_true",
+        help="write over the remote files, instead of uploading them to a temporary name "
+             "and renaming it over the old file"
+    )
+
+    parser.add_argument(
+        "--releases",
+        metavar="N",
+        type=int,
+        help="deploy to a new directory in remote-path/{0} each time, seeded with the unchanged files "
+             "of the previous one, then switch the remote-path/{1} symbolic link to it, "
+             "keeping the last N releases".format(RELEASES_DIR, CURRENT_LINK)
+    )
+
+    parser.add_argument(
+        "--files-from",
+        metavar="list-path",
+        type=str,
+        help="sync only the paths (relative to local-path) listed in this file, one per line or "
+             "NUL-separated, - for the standard input"
+    )
+
+    parser.add_argument(
+        "--git",
+        action="store_true",
+        help="sync only the paths git says changed since the last commit deployed this way "
+             "(recorded in remote-path/{}), instead of scanning the trees".format(GIT_STATE_FILE)
+    )
+
+    parser.add_argument(
+        "--retries",
+        metavar="N",
+        type=int,
+        help="times an operation is retried when the connection is lost, after reconnecting "
+             "(defaults to {})".format(DEFAULT_RETRIES)
+    )
+
+    parser.add_argument(
+        "--journal",
+        metavar="journal-path",
+        help="record the sync progress in this file, to resume an interrupted sync without scanning again"
+    )
+
+    parser.add_argument(
+        "--listing-requests",
+        metavar="N",
+        type=int,
+        help="number of READDIR requests in flight while streaming a remote directory (defaults to {})".format(
+            DEFAULT_LISTING_REQUESTS)
+    )
+
+    parser.add_argument(
+        "--local-threads",
+        metavar="N",
+        type=int,
+        help="number of threads listing local directories ahead of the comparison, "
+             "useful on network file systems"
+    )
+
+    parser.add_argument(
+        "--connections",
+        metavar="N",
+        type=int,
+        help="number of SSH connections sharing the scan and the uploads (defaults to {})".format(
+            DEFAULT_CONNECTIONS)
+    )
+
+    parser.add_argument(
+        "--processes",
+        metavar="N",
+        type=int,
+        help="number of processes, each with its own SSH connections, sharing the uploads (defaults to {})".format(
+            DEFAULT_PROCESSES)
+    )
+
+    parser.add_argument(
+        "--chunked-size",
+        metavar="size",
+        type=parse_size,
+        help="split files larger than size (K, M and G suffixes allowed, defaults to 64M) into chunks, "
+             "uploaded at the same time by several channels, 0 to disable it"
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check the chunks of uploaded files against their hashes, computed by the server"
+    )
+
+    parser.add_argument(
+        "--read-ahead",
+        metavar="size",
+        type=parse_size,
+        help="read small files in memory ahead of their upload, using up to size bytes "
+             "(K, M and G suffixes allowed)"
+    )
+
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="adjust the number of uploading channels (up to {}, or --channels) and of pipelined requests "
+             "to the measured round-trip time and throughput".format(ADAPTIVE_MAX_CHANNELS)
+    )
+
+    parser.add_argument(
+        "--bwlimit",
+        metavar="rate",
+        type=str,
+        help="limit the upload bandwidth to rate bytes/sec (K, M and G suffixes allowed), "
+             "optionally by time of the day, e.g. '08:00-18:00=512K,4M'"
+    )
+
     return parser
 
 
@@ -763,6 +3415,14 @@ def main(args=None):
     log_level = log_mapping[args['logging']]
     del(args['logging'])
 
+    if args['daemon']:
+        from sftpclone.daemon import serve
+        serve(args['daemon'], log_level)
+        return
+
+    if not args['path'] or not args['remote']:
+        parser.error("the following arguments are required: local-path, remote")
+
     global logger
     logger = configure_logging(log_level)
 
@@ -774,6 +3434,8 @@ def main(args=None):
         "known_hosts": "known_hosts_path",
         "do_not_delete": "delete",
         "key": "identity_files",
+        "journal": "journal_path",
+        "in_place": "atomic",
     }
 
     kwargs = {  # convert the argument names to class constructor parameters
@@ -793,18 +3455,63 @@ def main(args=None):
         kwargs['known_hosts_path'] = None
         del(kwargs['disable_known_hosts'])
 
+    # 0 is meaningful here
+    if args.get('chunked_size') == 0:
+        kwargs['chunked_size'] = 0
+    if args.get('retries') == 0:
+        kwargs['retries'] = 0
+
     # Toggle `do_not_delete` flag
     if "delete" in kwargs:
         kwargs["delete"] = not kwargs["delete"]
+    # and `in_place`
+    if "atomic" in kwargs:
+        kwargs["atomic"] = not kwargs["atomic"]
 
     # Manually set the default identity file.
     kwargs["identity_files"] = kwargs.get("identity_files", None) or ["~/.ssh/id_rsa"]
 
+    watch = kwargs.pop("watch", False)
+
+    if watch and kwargs.get("releases"):
+        parser.error("--watch can't be used with --releases")
+    if kwargs.get("git") and kwargs.get("releases"):
+        parser.error("--git can't be used with --releases")
+    if kwargs.get("files_from") and (kwargs.get("git") or kwargs.get("releases")):
+        parser.error("--files-from can't be used with --git or --releases")
+
+    control = kwargs.pop("control", None)
+    if control:
+        if watch:
+            parser.error("--watch can't be used with --control")
+
+        # the daemon runs in another directory
+        kwargs["local_path"] = os.path.abspath(os.path.expanduser(kwargs["local_path"]))
+        if kwargs.get("files_from") == "-":
+            parser.error("--files-from - can't be used with --control")
+        if (kwargs.get("processes") or 1) > 1:
+            parser.error("--processes can't be used with --control")
+        for k in ("exclude_file", "ssh_config_path", "known_hosts_path", "files_from"):
+            if kwargs.get(k):
+                kwargs[k] = os.path.abspath(os.path.expanduser(kwargs[k]))
+        kwargs["identity_files"] = [
+            os.path.abspath(os.path.expanduser(k)) for k in kwargs["identity_files"]
+        ]
+
+        from sftpclone.daemon import submit_job
+        sys.exit(submit_job(control, kwargs, log_level))
+
     sync = SFTPClone(
         **kwargs
     )
     sync.run()
 
+    if watch:
+        try:
+            sync.watch()
+        except KeyboardInterrupt:
+            pass
+
 
 if __name__ == '__main__':
     main()
@@ -24,10 +24,17 @@ A stub SFTP server for loopback SFTP testing.
 """
 
 import os
+import shlex
+import shutil
+import struct
+import threading
 from paramiko import ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes, \
-    SFTPHandle, SFTP_OK, AUTH_SUCCESSFUL, AUTH_FAILED, OPEN_SUCCEEDED, RSAKey
+    SFTPHandle, SFTP_OK, SFTP_FAILURE, AUTH_SUCCESSFUL, AUTH_FAILED, OPEN_SUCCEEDED, RSAKey
 from paramiko.common import o666
+from paramiko.message import Message
+from paramiko.sftp import CMD_EXTENDED, CMD_EXTENDED_REPLY, CMD_INIT, CMD_NAME, CMD_VERSION, SFTP_EOF, SFTPError
 
+from sftpclone.sftpclone import fsdecode, fsencode
 from sftpclone.t.utils import t_path
 
 USERNAME = "test"
@@ -37,6 +44,13 @@ RSA_KEY = t_path("id_rsa")
 SERVER_ROOT = "server_root"
 
 
+class FileNameMessage (Message):
+    """A message whose strings are decoded as file names, so that those which aren't valid UTF-8 work too."""
+
+    def get_text(self):
+        return fsdecode(self.get_string())
+
+
 class StubServer (ServerInterface):
 
     good_pub_key = RSAKey(filename=RSA_KEY)
@@ -54,6 +68,45 @@ class StubServer (ServerInterface):
     def check_channel_request(self, kind, chanid):
         return OPEN_SUCCEEDED
 
+    # how commands are executed, patch it to simulate other servers: None refuses them,
+    # "shell" runs the few below, "sftp" is an account forced to run an SFTP server instead
+    exec_mode = None
+    # the commands executed so far
+    commands = []
+
+    def check_channel_exec_request(self, channel, command):
+        if self.exec_mode is None:
+            return False
+        self.commands.append(fsdecode(command))
+        threading.Thread(target=self._exec, args=(channel, fsdecode(command)), name="exec").start()
+        return True
+
+    def _exec(self, channel, command):
+        # until EOF, sent once the exec request is granted (or an SFTP server waits for requests)
+        while channel.recv(32768):
+            pass
+        if self.exec_mode == "sftp":
+            status = 0  # whatever the command was
+        else:
+            status = self._run(channel, shlex.split(command))
+        channel.send_exit_status(status)
+        channel.close()
+
+    def _run(self, channel, args):
+        if args[0] == "echo":
+            channel.sendall(fsencode(" ".join(args[1:]) + "\n"))
+            return 0
+        if args[0] == "cp":
+            source, destination = (StubSFTPServer(self)._realpath(path) for path in args[-2:])
+            try:
+                shutil.copyfile(source, destination)
+            except (IOError, OSError) as e:
+                channel.sendall_stderr(fsencode("cp: {}\n".format(e)))
+                return 1
+            return 0
+        channel.sendall_stderr(fsencode("{}: command not found\n".format(args[0])))
+        return 127
+
 
 class StubSFTPHandle (SFTPHandle):
 
@@ -73,14 +126,107 @@ class StubSFTPHandle (SFTPHandle):
             return SFTPServer.convert_errno(e.errno)
 
 
+class StubSFTPSubsystem (SFTPServer):
+    """SFTP subsystem speaking some of the OpenSSH protocol extensions too."""
+
+    # extension name -> version, patch it to simulate other servers
+    extensions = {
+        "hardlink@openssh.com": "1",
+        "copy-data": "1",
+        "limits@openssh.com": "1",
+        "posix-rename@openssh.com": "1",
+    }
+    # max packet, read and write lengths, open handles (like OpenSSH's)
+    limits = (256 * 1024, 255 * 1024, 255 * 1024, 0)
+
+    def _send_server_version(self):
+        # like paramiko's, but advertising the extensions too
+        t, data = self._read_packet()
+        if t != CMD_INIT:
+            raise SFTPError("Incompatible sftp protocol")
+        msg = Message()
+        msg.add_int(3)
+        msg.add("check-file", "md5,sha1")
+        for name, version in sorted(self.extensions.items()):
+            msg.add(name, version)
+        self._send_packet(CMD_VERSION, msg)
+        return struct.unpack(">I", data[:4])[0]
+
+    def _copy_data(self, read_handle, read_offset, length, write_handle, write_offset):
+        if read_handle not in self.file_table or write_handle not in self.file_table:
+            return SFTP_FAILURE
+        src, dst = self.file_table[read_handle], self.file_table[write_handle]
+        while True:
+            data = src.read(read_offset, 32768 if not length else min(length, 32768))
+            if not isinstance(data, bytes):
+                return data  # error code
+            if not data:
+                return SFTP_OK
+            dst.write(write_offset, data)
+            read_offset += len(data)
+            write_offset += len(data)
+            if length:
+                length -= len(data)
+                if not length:
+                    return SFTP_OK
+
+    def _read_folder(self, request_number, folder):
+        # like paramiko's, but sending the names as they are on disk
+        flist = folder._get_next_files()
+        if len(flist) == 0:
+            self._send_status(request_number, SFTP_EOF)
+            return
+        msg = Message()
+        msg.add_int(request_number)
+        msg.add_int(len(flist))
+        for attr in flist:
+            msg.add_string(fsencode(attr.filename))
+            msg.add_string(fsencode(str(attr)))
+            attr._pack(msg)
+        self._send_packet(CMD_NAME, msg)
+
+    def _process(self, t, request_number, msg):
+        msg.__class__ = FileNameMessage
+        if t == CMD_EXTENDED:
+            start = msg.packet.tell()
+            tag = msg.get_text()
+            if tag in self.extensions:
+                if tag == "hardlink@openssh.com":
+                    oldpath = msg.get_text()
+                    newpath = msg.get_text()
+                    self._send_status(
+                        request_number, self.server.hardlink(oldpath, newpath)
+                    )
+                    return
+                if tag == "limits@openssh.com":
+                    reply = Message()
+                    reply.add_int(request_number)
+                    for limit in self.limits:
+                        reply.add_int64(limit)
+                    self._send_packet(CMD_EXTENDED_REPLY, reply)
+                    return
+                if tag == "copy-data":
+                    self._send_status(request_number, self._copy_data(
+                        msg.get_binary(), msg.get_int64(), msg.get_int64(),
+                        msg.get_binary(), msg.get_int64()
+                    ))
+                    return
+            msg.packet.seek(start)
+
+        SFTPServer._process(self, t, request_number, msg)
+
+
 class StubSFTPServer (SFTPServerInterface):
     ROOT = t_path(SERVER_ROOT)
 
     def _realpath(self, path):
-        return self.ROOT + self.canonicalize(path)
+        try:
+            return self.ROOT + self.canonicalize(path)
+        except UnicodeDecodeError:  # Python 2.x, a name which can't be decoded
+            return fsencode(self.ROOT) + self.canonicalize(path)
 
     def list_folder(self, path):
-        path = self._realpath(path)
+        path = fsencode(self._realpath(path))  # the names as they are on disk
         try:
             out = []
             flist = os.listdir(path)
@@ -88,7 +234,7 @@ class StubSFTPServer (SFTPServerInterface):
                 attr = SFTPAttributes.from_stat(
                     os.lstat(os.path.join(path, fname))
                 )
-                attr.filename = fname.encode("utf-8")
+                attr.filename = fsencode(fname)
                 out.append(attr)
             return out
         except OSError as e:
@@ -165,6 +311,24 @@ class StubSFTPServer (SFTPServerInterface):
             return SFTPServer.convert_errno(e.errno)
         return SFTP_OK
 
+    def posix_rename(self, oldpath, newpath):
+        oldpath = self._realpath(oldpath)
+        newpath = self._realpath(newpath)
+        try:
+            os.rename(oldpath, newpath)  # replaces newpath
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def hardlink(self, oldpath, newpath):
+        oldpath = self._realpath(oldpath)
+        newpath = self._realpath(newpath)
+        try:
+            os.link(oldpath, newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
     def mkdir(self, path, attr):
         path = self._realpath(path)
         try:
@@ -217,4 +381,4 @@ class StubSFTPServer (SFTPServerInterface):
                     symlink = '/' + symlink
             else:
                 symlink = '<error>'
-        return symlink
+        return fsencode(symlink)
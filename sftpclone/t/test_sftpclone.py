@@ -13,25 +13,37 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import functools
+import io
+import json
 import logging
+import mmap
 import os
 import random
 import select
 import socket
+import subprocess
+import sys
 import threading
+import time
 import unicodedata
 
+from collections import Counter
 from os.path import join
 from shutil import rmtree, copy
 from stat import S_ISDIR
 
 import paramiko
+from paramiko.sftp import CMD_WRITE
 
 from nose import with_setup
+from nose.plugins.skip import SkipTest
 from nose.tools import assert_raises, raises, eq_
 
-from sftpclone.sftpclone import SFTPClone, main, parse_username_password_hostname, get_ssh_agent_keys
-from sftpclone.t.stub_sftp import StubServer, StubSFTPServer
+from sftpclone.sftpclone import SFTPClone, main, parse_username_password_hostname, get_ssh_agent_keys, \
+    parse_bwlimit, TokenBucket, shard_by_size, Action, Chunk, ReadAhead, ConcurrencyController, LocalScanner, \
+    data_extents, file_digest, fsencode, printable, Capabilities, Stat, _Replies, _SFTPClient
+from sftpclone.daemon import SyncDaemon, submit_job
+from sftpclone.t.stub_sftp import StubServer, StubSFTPHandle, StubSFTPServer, StubSFTPSubsystem
 from sftpclone.t.utils import t_path, list_files, file_tree, \
     suppress_logging, capture_sys_output, override_env_variables, override_ssh_auth_env
 
@@ -79,7 +91,7 @@ def _start_sftp_server():
             host_key = paramiko.RSAKey.from_private_key_file(t_path('server_id_rsa'))
             ts.add_server_key(host_key)
             server = StubServer()
-            ts.set_subsystem_handler('sftp', paramiko.SFTPServer, StubSFTPServer)
+            ts.set_subsystem_handler('sftp', StubSFTPSubsystem, StubSFTPServer)
             ts.start_server(server=server)
 
     sock.close()
@@ -130,6 +142,7 @@ def _sync(
         password=False, fix=False,
         exclude=None, ssh_agent=False,
         delete=True, identity_files=None,
+        **kwargs
 ):
     """Launch sync and do basic comparison of dir trees."""
     if not password:
@@ -148,7 +161,8 @@ def _sync(
         identity_files=identity_files,
         exclude_file=exclude,
         ssh_agent=ssh_agent,
-        delete=delete
+        delete=delete,
+        **kwargs
     ).run()
 
     if not exclude and delete:
@@ -218,6 +232,39 @@ def test_parse_username_password_hostname():
         assert_raises(AssertionError, parse_username_password_hostname, test)
 
 
+def test_parse_bwlimit():
+    """Test parsing bandwidth limits."""
+    ground_truth = {
+        '1000': (1000, []),
+        '512K': (512 * 1024, []),
+        '1.5m': (int(1.5 * 1024 * 1024), []),
+        '08:00-18:30=512K,4M': (4 * 1024 * 1024, [(8 * 60, 18 * 60 + 30, 512 * 1024)]),
+        '22:00-6:00=0': (0, [(22 * 60, 6 * 60, 0)]),
+    }
+
+    for test, truth in ground_truth.items():
+        assert parse_bwlimit(test) == truth
+
+    for test in {'', 'fast', '1X', '8-18=1K', '08:00=1K'}:
+        assert_raises(ValueError, parse_bwlimit, test)
+
+
+def test_token_bucket():
+    """Test the bandwidth limit schedule and rate."""
+    bucket = TokenBucket(1, [(8 * 60, 18 * 60, 2), (22 * 60, 6 * 60, 3)])
+    for (hour, minute), rate in {(7, 59): 1, (8, 0): 2, (17, 59): 2, (18, 0): 1, (23, 0): 3, (5, 59): 3}.items():
+        now = time.struct_time((2020, 1, 1, hour, minute, 0, 2, 1, -1))
+        with mock.patch('time.localtime', return_value=now):
+            eq_(bucket.current_rate(), rate)
+
+    bucket = TokenBucket(256 * 1024, burst=0.5)
+    start = time.time()
+    for _ in range(16):
+        bucket.consume(32 * 1024)
+    # 512 KiB at 256 KiB/s, with a 128 KiB burst
+    assert 1.2 < time.time() - start < 2
+
+
 @with_setup(setup_test, teardown_test)
 def test_cli_args():
     """Test CLI arguments."""
@@ -724,6 +771,735 @@ def test_long_unicode_file():
     _sync()
 
 
+@with_setup(setup_test, teardown_test)
+def test_hard_links():
+    """Test that local hard links are recreated on the remote side."""
+    os.mkdir(join(LOCAL_FOLDER, "dir"))
+    with open(join(LOCAL_FOLDER, "first"), 'w') as f:
+        print("Some shared content.", file=f)
+    os.link(join(LOCAL_FOLDER, "first"), join(LOCAL_FOLDER, "second"))
+    os.link(join(LOCAL_FOLDER, "first"), join(LOCAL_FOLDER, "dir", "third"))
+
+    # a stale remote copy has to be replaced by the link
+    with open(join(REMOTE_PATH, "second"), 'w') as f:
+        print("Stale.", file=f)
+
+    _sync(hard_links=True)
+
+    inodes = {
+        os.stat(join(REMOTE_PATH, f)).st_ino
+        for f in ("first", "second", join("dir", "third"))
+    }
+    assert len(inodes) == 1
+    assert os.stat(join(REMOTE_PATH, "first")).st_nlink == 3
+
+
+@with_setup(setup_test, teardown_test)
+def test_hard_links_unsupported():
+    """Test hard links fallback to uploads when the server lacks the extension."""
+    with open(join(LOCAL_FOLDER, "first"), 'w') as f:
+        print("Some shared content.", file=f)
+    os.link(join(LOCAL_FOLDER, "first"), join(LOCAL_FOLDER, "second"))
+
+    with mock.patch.dict(StubSFTPSubsystem.extensions, clear=True):
+        _sync(hard_links=True)
+
+    assert os.stat(join(REMOTE_PATH, "first")).st_nlink == 1
+    with open(join(REMOTE_PATH, "second")) as f:
+        assert f.read() == "Some shared content.\n"
+
+
+@with_setup(setup_test, teardown_test)
+def test_dedupe():
+    """Test that duplicated files are copied on the remote side instead of uploaded."""
+    content = os.urandom(64 * 1024)
+    os.mkdir(join(LOCAL_FOLDER, "vendor"))
+    for f in ("lib.js", join("vendor", "lib.js"), "lib.0123abcd.js"):
+        with open(join(LOCAL_FOLDER, f), 'wb') as fd:
+            fd.write(content)
+    with open(join(LOCAL_FOLDER, "unique.js"), 'wb') as fd:
+        fd.write(os.urandom(48 * 1024))
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        dedupe=True,
+    )
+    hashed = []
+
+    def digest(path):
+        assert not sync._scan_lock.locked()
+        hashed.append(os.path.relpath(path, LOCAL_FOLDER))
+        return file_digest(path)
+
+    with mock.patch('sftpclone.sftpclone.SFTPClone.file_upload', autospec=True,
+                    side_effect=SFTPClone.file_upload) as put, \
+            mock.patch('sftpclone.sftpclone.file_digest', side_effect=digest):
+        sync.run()
+    sync.close()
+    eq_(put.call_count, 2)
+    # only the files having the same size as another one, once the scan is over
+    eq_(sorted(hashed), sorted(["lib.js", join("vendor", "lib.js"), "lib.0123abcd.js"]))
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+
+    for f in ("lib.js", join("vendor", "lib.js"), "lib.0123abcd.js"):
+        with open(join(REMOTE_PATH, f), 'rb') as fd:
+            assert fd.read() == content
+        assert int(os.stat(join(LOCAL_FOLDER, f)).st_mtime) == int(os.stat(join(REMOTE_PATH, f)).st_mtime)
+
+    # already synced files are used as sources too
+    with open(join(LOCAL_FOLDER, "lib.fedcba98.js"), 'wb') as fd:
+        fd.write(content)
+
+    with mock.patch.dict(StubSFTPSubsystem.extensions, clear=True):
+        with mock.patch('sftpclone.sftpclone.SFTPClone.file_upload', autospec=True,
+                        side_effect=SFTPClone.file_upload) as put:
+            # neither copy-data nor exec are available: upload it
+            _sync(dedupe=True)
+            assert put.call_count == 1
+
+    with open(join(REMOTE_PATH, "lib.fedcba98.js"), 'rb') as fd:
+        assert fd.read() == content
+
+    # no copy-data, but `cp` can be executed
+    for mode, uploads in (("shell", 0), ("sftp", 1)):
+        with open(join(LOCAL_FOLDER, "lib.{}.js".format(mode)), 'wb') as fd:
+            fd.write(content)
+        with mock.patch.dict(StubSFTPSubsystem.extensions, clear=True), \
+                mock.patch.object(StubServer, 'exec_mode', mode), \
+                mock.patch.object(Capabilities, 'exec_allowed', True), \
+                mock.patch('sftpclone.sftpclone.SFTPClone.file_upload', autospec=True,
+                           side_effect=SFTPClone.file_upload) as put:
+            # an account forced to run an SFTP server ends the `cp`, which copies nothing
+            _sync(dedupe=True)
+            eq_(put.call_count, uploads)
+        with open(join(REMOTE_PATH, "lib.{}.js".format(mode)), 'rb') as fd:
+            assert fd.read() == content
+
+
+@with_setup(setup_test, teardown_test)
+def test_sync_path():
+    """Test syncing single paths of the tree."""
+    os.mkdir(join(LOCAL_FOLDER, "dir"))
+    os.open(join(LOCAL_FOLDER, "dir", "file"), os.O_CREAT)
+    os.open(join(LOCAL_FOLDER, "untouched"), os.O_CREAT)
+    os.open(join(REMOTE_PATH, "stale"), os.O_CREAT)
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        remote_url='test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+    )
+
+    sync.sync_path("dir")
+    assert os.listdir(join(REMOTE_PATH, "dir")) == []
+
+    sync.sync_paths({"dir": True, join("dir", "file"): False, "stale": False})
+    assert set(os.listdir(REMOTE_PATH)) == {"dir"}
+    assert os.listdir(join(REMOTE_PATH, "dir")) == ["file"]
+
+    rmtree(join(LOCAL_FOLDER, "dir"))
+    os.open(join(LOCAL_FOLDER, "dir"), os.O_CREAT)
+    sync.sync_path("dir")
+    assert not S_ISDIR(os.stat(join(REMOTE_PATH, "dir")).st_mode)
+
+
+@with_setup(setup_test, teardown_test)
+def test_watch():
+    """Test that local changes reach the remote side in watch mode."""
+    os.open(join(LOCAL_FOLDER, "old"), os.O_CREAT)
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        remote_url='test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+    )
+    sync.run()
+
+    stop = threading.Event()
+    t = threading.Thread(target=sync.watch, args=(stop,))
+    t.start()
+    try:
+        time.sleep(0.5)
+        os.mkdir(join(LOCAL_FOLDER, "new"))
+        with open(join(LOCAL_FOLDER, "new", "file"), 'w') as f:
+            print("Hello.", file=f)
+        os.remove(join(LOCAL_FOLDER, "old"))
+
+        for _ in range(40):
+            time.sleep(0.1)
+            if file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]:
+                break
+        assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+        with open(join(REMOTE_PATH, "new", "file")) as f:
+            assert f.read() == "Hello.\n"
+
+        # the connection is lost, and can't be opened again for a while:
+        # the changes are synced later on
+        failures = [socket.error("Connection refused")] * 2
+
+        def open_transport(self):
+            if failures:
+                raise failures.pop()
+            return _open_transport(self)
+
+        _open_transport = SFTPClone._open_transport
+        sync.retries = 1
+        with mock.patch('sftpclone.sftpclone.RETRY_DELAY', 0.1), \
+                mock.patch.object(SFTPClone, '_open_transport', open_transport):
+            sync.transport.close()
+            os.open(join(LOCAL_FOLDER, "offline"), os.O_CREAT)
+            for _ in range(100):
+                time.sleep(0.1)
+                if os.path.exists(join(REMOTE_PATH, "offline")):
+                    break
+        assert not failures
+        assert t.is_alive()
+        assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+    finally:
+        stop.set()
+        t.join()
+
+
+@with_setup(setup_test, teardown_test)
+def test_daemon():
+    """Test running sync jobs through the daemon, on the same connection."""
+    socket_path = t_path("daemon.sock")
+    daemon = SyncDaemon(socket_path)
+    t = threading.Thread(target=daemon.serve_forever)
+    t.start()
+
+    options = {
+        "local_path": LOCAL_FOLDER,
+        "remote_url": 'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        "port": 2222,
+        "identity_files": [t_path("id_rsa")],
+    }
+
+    try:
+        os.open(join(LOCAL_FOLDER, "first"), os.O_CREAT)
+        with capture_sys_output():
+            assert submit_job(socket_path, options) == 0
+        assert os.listdir(REMOTE_PATH) == ["first"]
+        transports = list(daemon._transports.values())
+
+        os.open(join(LOCAL_FOLDER, "second"), os.O_CREAT)
+        with capture_sys_output():
+            assert submit_job(socket_path, options) == 0
+        assert set(os.listdir(REMOTE_PATH)) == {"first", "second"}
+        assert list(daemon._transports.values()) == transports
+
+        # more connections are opened with the credentials of the first one
+        os.open(join(LOCAL_FOLDER, "third"), os.O_CREAT)
+        with mock.patch.object(SFTPClone, '_open_transport', autospec=True,
+                               side_effect=SFTPClone._open_transport) as open_transport:
+            with capture_sys_output():
+                assert submit_job(socket_path, dict(options, connections=2)) == 0
+        eq_(open_transport.call_count, 1)
+        assert list(daemon._transports.values()) == transports
+        with capture_sys_output() as (_, err):
+            assert submit_job(socket_path, dict(options, processes=2), logging.ERROR) == 2
+        assert "can't be forked" in err.getvalue()
+
+        # a connection opened again during a job is kept, instead of the lost one
+        scan = SFTPClone.scan
+
+        def lose_connection(self, *args, **kwargs):
+            self.transport.close()
+            return scan(self, *args, **kwargs)
+
+        os.open(join(LOCAL_FOLDER, "fourth"), os.O_CREAT)
+        with mock.patch.object(SFTPClone, 'scan', lose_connection):
+            with capture_sys_output():
+                assert submit_job(socket_path, options) == 0
+        assert set(os.listdir(REMOTE_PATH)) == {"first", "second", "third", "fourth"}
+        kept = list(daemon._transports.values())
+        assert kept != transports and kept[0].is_active()
+
+        # job failures are reported back
+        options["local_path"] = join(LOCAL_FOLDER, "missing")
+        with capture_sys_output() as (_, err):
+            assert submit_job(socket_path, options, logging.ERROR) == 1
+        assert "Local path MUST exist" in err.getvalue()
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
+        t.join()
+
+    assert not os.path.exists(socket_path)
+
+
+@with_setup(setup_test, teardown_test)
+def test_dry_run():
+    """Test printing the sync plan without executing it."""
+    os.mkdir(join(LOCAL_FOLDER, "dir"))
+    with open(join(LOCAL_FOLDER, "dir", "file"), 'w') as f:
+        print("Hello.", file=f)
+    os.symlink("dir", join(LOCAL_FOLDER, "link"))
+    os.open(join(REMOTE_PATH, "stale"), os.O_CREAT)
+
+    with capture_sys_output() as (out, _):
+        main([
+            LOCAL_FOLDER,
+            'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+            '-k', t_path("id_rsa"),
+            '-p', "2222",
+            '-d', '-o',
+            '--plan-json',
+        ])
+
+    assert os.listdir(REMOTE_PATH) == ["stale"]
+    plan = {(a["action"], a["path"]): a for a in json.loads(out.getvalue())}
+    assert set(plan) == {
+        ("delete", "stale"),
+        ("mkdir", "dir"),
+        ("upload", join("dir", "file")),
+        ("setstat", "dir"),
+        ("symlink", "link"),
+    }
+    assert plan[("upload", join("dir", "file"))]["size"] == 7
+    assert plan[("symlink", "link")]["source"] == "dir"
+
+    with capture_sys_output() as (out, _):
+        SFTPClone(
+            LOCAL_FOLDER,
+            remote_url='test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+            port=2222,
+            identity_files=[t_path("id_rsa")],
+            dry_run=True,
+        ).run()
+    assert os.listdir(REMOTE_PATH) == ["stale"]
+    assert "7 bytes to upload" in out.getvalue()
+
+    _sync()
+    assert int(os.stat(join(LOCAL_FOLDER, "dir")).st_mtime) == int(os.stat(join(REMOTE_PATH, "dir")).st_mtime)
+
+
+@with_setup(setup_test, teardown_test)
+def test_parallel_uploads():
+    """Test uploading large and small files over several channels."""
+    contents = {}
+    for i in range(3):
+        contents["large{}".format(i)] = os.urandom(9 * 1024 * 1024 + i)
+    os.mkdir(join(LOCAL_FOLDER, "small"))
+    for i in range(150):
+        contents[join("small", str(i))] = os.urandom(i)
+
+    for f, content in contents.items():
+        with open(join(LOCAL_FOLDER, f), 'wb') as fd:
+            fd.write(content)
+
+    _sync(channels=3, bwlimit="1G")
+
+    for f, content in contents.items():
+        with open(join(REMOTE_PATH, f), 'rb') as fd:
+            assert fd.read() == content
+
+
+@with_setup(setup_test, teardown_test)
+def test_connections():
+    """Test sharing the scan and the uploads among several SSH connections."""
+    for d in range(6):
+        os.makedirs(join(LOCAL_FOLDER, "dir{}".format(d), "sub"))
+        for f in range(10):
+            with open(join(LOCAL_FOLDER, "dir{}".format(d), "sub", str(f)), 'wb') as fd:
+                fd.write(os.urandom(d * 100 + f))
+        os.mkdir(join(REMOTE_PATH, "dir{}".format(d)))
+        with open(join(REMOTE_PATH, "dir{}".format(d), "stale"), 'w') as fd:
+            fd.write("stale")
+    os.link(join(LOCAL_FOLDER, "dir0", "sub", "0"), join(LOCAL_FOLDER, "dir5", "link"))
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test:secret@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        hard_links=True,
+        connections=3,
+    )
+    assert len(sync.transports) == 3
+    assert len(set(t.sock.getsockname() for t in sync.transports)) == 3
+    sync.run()
+    sync.close()
+
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+    assert os.stat(join(REMOTE_PATH, "dir0", "sub", "0")).st_ino == \
+        os.stat(join(REMOTE_PATH, "dir5", "link")).st_ino
+
+    # with public key authentication, too
+    with open(join(LOCAL_FOLDER, "dir1", "new"), 'w') as fd:
+        fd.write("new")
+    _sync(connections=2)
+
+
+def test_shard_by_size():
+    """Test splitting actions into shards of about the same size."""
+    actions = [Action("upload", str(size), size, None, None) for size in (1, 9, 3, 5, 5, 2, 7)]
+    shards = shard_by_size(actions, 3)
+    assert sorted(sum(a.size for a in shard) for shard in shards) == [10, 11, 11]
+    assert sorted(a.path for shard in shards for a in shard) == sorted(a.path for a in actions)
+
+    assert len(shard_by_size(actions[:2], 4)) == 2
+
+
+@with_setup(setup_test, teardown_test)
+def test_processes():
+    """Test sharing the uploads among several processes."""
+    contents = {}
+    for d in range(4):
+        os.mkdir(join(LOCAL_FOLDER, str(d)))
+        for f in range(8):
+            contents[join(str(d), str(f))] = os.urandom(d * 10000 + f)
+    for f, content in contents.items():
+        with open(join(LOCAL_FOLDER, f), 'wb') as fd:
+            fd.write(content)
+    with open(join(REMOTE_PATH, "stale"), 'w') as fd:
+        fd.write("stale")
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        processes=3,
+    )
+    with mock.patch('os.fork', side_effect=os.fork) as fork:
+        sync.run()
+    sync.close()
+
+    assert fork.call_count == 3
+    assert sync.stats["upload"] == len(contents)
+    assert sync.stats["bytes"] == sum(len(c) for c in contents.values())
+    assert sync.stats["mkdir"] == 4 and sync.stats["delete"] == 1
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+
+
+@with_setup(setup_test, teardown_test)
+def test_chunked_upload():
+    """Test uploading a file in chunks, written at the same time by several channels."""
+    content = os.urandom(1024 * 1024 + 123)
+    local_file = join(LOCAL_FOLDER, "huge")
+    with open(local_file, 'wb') as fd:
+        fd.write(content)
+    with open(join(LOCAL_FOLDER, "small"), 'wb') as fd:
+        fd.write(b"small")
+    # it must shrink too
+    with open(join(REMOTE_PATH, "huge"), 'wb') as fd:
+        fd.write(os.urandom(2 * 1024 * 1024))
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        chunked_size=256 * 1024,
+        verify=True,
+    )
+    with mock.patch('sftpclone.sftpclone.CHUNK_SIZE', 128 * 1024), \
+            mock.patch.object(sync, '_upload_chunk', side_effect=sync._upload_chunk) as upload_chunk:
+        sync.run()
+
+    assert upload_chunk.call_count == 9
+    assert len(set(c[0][1] for c in upload_chunk.call_args_list)) > 1  # channels
+    assert sync.verify  # the server can hash files
+    assert sync.stats["upload"] == 2 and sync.stats["bytes"] == len(content) + 5
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+    with open(join(REMOTE_PATH, "huge"), 'rb') as fd:
+        assert fd.read() == content
+    eq_(int(os.stat(local_file).st_mtime), int(os.stat(join(REMOTE_PATH, "huge")).st_mtime))
+
+    # a chunk that doesn't match
+    with open(local_file, 'r+b') as fd:
+        fd.seek(200 * 1024)
+        fd.write(b"corrupt")
+    action = Action("upload", "huge", len(content), os.lstat(local_file), None)
+    sync._verify_chunk(Chunk(action, 0, 128 * 1024), sync.sftp)
+    assert_raises(IOError, sync._verify_chunk, Chunk(action, 128 * 1024, 128 * 1024), sync.sftp)
+    sync.close()
+
+
+@with_setup(setup_test, teardown_test)
+def test_upload_reader():
+    """Test uploading files memory-mapped or through the read buffer."""
+    contents = {
+        "empty": b"",
+        "small": os.urandom(1000),
+        "buffered": os.urandom(3 * 256 * 1024 + 5),
+        "mapped": os.urandom(2 * 1024 * 1024 + 7),
+    }
+    for f, content in contents.items():
+        with open(join(LOCAL_FOLDER, f), 'wb') as fd:
+            fd.write(content)
+
+    with mock.patch('mmap.mmap', side_effect=mmap.mmap) as mapped:
+        _sync()
+    assert mapped.call_count == 1
+
+    for f, content in contents.items():
+        with open(join(REMOTE_PATH, f), 'rb') as fd:
+            assert fd.read() == content
+
+    # where memory maps aren't available
+    rmtree(REMOTE_PATH)
+    os.mkdir(REMOTE_PATH)
+    with mock.patch('mmap.mmap', side_effect=mmap.error):
+        _sync()
+
+    with open(join(REMOTE_PATH, "mapped"), 'rb') as fd:
+        assert fd.read() == contents["mapped"]
+
+    # or can't be viewed (Python 2.x)
+    def py2_memoryview(obj):
+        if isinstance(obj, mmap.mmap):
+            raise TypeError("cannot make memory view because object does not have the buffer interface")
+        return memoryview(obj)
+
+    rmtree(REMOTE_PATH)
+    os.mkdir(REMOTE_PATH)
+    with mock.patch('sftpclone.sftpclone.memoryview', side_effect=py2_memoryview, create=True):
+        _sync()
+
+    with open(join(REMOTE_PATH, "mapped"), 'rb') as fd:
+        assert fd.read() == contents["mapped"]
+
+
+@with_setup(setup_test, teardown_test)
+def test_read_ahead():
+    """Test reading files ahead of their upload, under a memory cap."""
+    paths = []
+    for i in range(20):
+        path = join(LOCAL_FOLDER, str(i))
+        with open(path, 'wb') as fd:
+            fd.write(os.urandom(1000 + i))
+        paths.append((path, 1000 + i))
+    paths.append((join(LOCAL_FOLDER, "missing"), 10))
+
+    read_ahead = ReadAhead(paths, 5000)
+    time.sleep(0.2)
+    assert read_ahead._used <= 5000
+
+    hits = 0
+    for path, size in paths[:-1]:
+        data = read_ahead.take(path)
+        if data is None:
+            continue  # not read yet: the uploader reads it
+        hits += 1
+        with open(path, 'rb') as fd:
+            assert fd.read() == data
+        read_ahead.release(size)
+    assert hits >= 4
+
+    assert read_ahead.take(paths[-1][0]) is None
+    read_ahead.stop()
+    assert read_ahead._used == 0
+
+    # too large to fit, or taken before being read
+    read_ahead = ReadAhead([(paths[0][0], 6000)], 5000)
+    assert read_ahead.take(paths[0][0]) is None
+    read_ahead.stop()
+
+    os.mkdir(join(LOCAL_FOLDER, "dir"))
+    with open(join(LOCAL_FOLDER, "dir", "large"), 'wb') as fd:
+        fd.write(os.urandom(9 * 1024 * 1024))
+    taken = []
+    original_take = ReadAhead.take
+
+    def take(self, path):
+        data = original_take(self, path)
+        taken.append(data is not None)
+        return data
+
+    for channels in (1, 4):
+        rmtree(REMOTE_PATH)
+        os.mkdir(REMOTE_PATH)
+        with mock.patch.object(ReadAhead, 'take', take):
+            _sync(read_ahead=4096, channels=channels)
+    # the large file is never read ahead
+    assert taken.count(True) > 0 and taken.count(False) >= 2 and len(taken) == 42
+
+
+def test_concurrency_controller():
+    """Test adjusting the concurrency to the throughput and the round-trip time."""
+    controller = ConcurrencyController(8, None)
+    eq_(controller.channels, 2)
+
+    # more channels, as long as the throughput holds
+    for throughput in (10e6, 20e6, 30e6, 30e6):
+        controller.update(throughput, 0.05)
+    eq_(controller.channels, 6)
+    assert controller.admits(5, 0) and not controller.admits(6, 0)
+    # 30 MB/s * 50 ms / 32 KiB / 6 channels, doubled
+    eq_(controller.depth, 16)
+
+    # the round-trip time grows: queues are filling up
+    for _ in range(3):
+        controller.update(30e6, 0.2)
+    assert controller.channels < 6
+    assert controller.rtt > 0.05 and controller.base_rtt == 0.05
+
+    controller = ConcurrencyController(3, None)
+    for _ in range(5):
+        controller.update(1e6, 0.001)
+    eq_(controller.channels, 3)
+    eq_(controller.depth, 4)
+
+    # the same bandwidth-delay product, in requests 8 times larger
+    controller = ConcurrencyController(8, None, request_size=8 * 32768)
+    for throughput in (10e6, 20e6, 30e6, 30e6):
+        controller.update(throughput, 0.4)
+    eq_(controller.depth, 16)
+
+
+@with_setup(setup_test, teardown_test)
+def test_adaptive():
+    """Test uploading with an adaptive concurrency."""
+    for i in range(40):
+        with open(join(LOCAL_FOLDER, str(i)), 'wb') as fd:
+            fd.write(os.urandom(i * 1000))
+    with open(join(LOCAL_FOLDER, "large"), 'wb') as fd:
+        fd.write(os.urandom(9 * 1024 * 1024))
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        adaptive=True,
+    )
+    with mock.patch.object(ConcurrencyController, 'sent', autospec=True,
+                           side_effect=ConcurrencyController.sent) as sent:
+        sync.run()
+    sync.close()
+
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+    # the small files are measured too
+    eq_(sum(c[0][1] for c in sent.call_args_list), sum(i * 1000 for i in range(40)) + 9 * 1024 * 1024)
+    assert 1 <= sync.stats["channels"] <= 16
+    assert sync.stats["pipeline depth"] >= 4
+    assert "Settled on" in sync.report()
+
+    # the server doesn't allow more sessions: one of those opened is kept for the probe
+    for i in range(40):
+        with open(join(LOCAL_FOLDER, str(i)), 'ab') as fd:
+            fd.write(b"more")
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        adaptive=True,
+        scan_channels=1,
+    )
+    from_transport = _SFTPClient.from_transport
+
+    def open_session(transport):
+        if open_.call_count > 3:
+            raise paramiko.ChannelException(1, "Administratively prohibited")
+        return from_transport(transport)
+
+    with mock.patch.object(_SFTPClient, 'from_transport', side_effect=open_session) as open_, \
+            mock.patch('sftpclone.sftpclone.SMALL_FILES_BATCH', 4):
+        sync.run()
+    sync.close()
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+    eq_(open_.call_count, 4)
+    assert 1 <= sync.stats["channels"] <= 3
+
+
+@with_setup(setup_test, teardown_test)
+def test_parallel_scan():
+    """Test listing several remote directories at the same time."""
+    for d in range(20):
+        for sub in range(3):
+            os.makedirs(join(LOCAL_FOLDER, str(d), str(sub)))
+            os.makedirs(join(REMOTE_PATH, str(d), str(sub)))
+            with open(join(LOCAL_FOLDER, str(d), str(sub), "file"), 'w') as fd:
+                fd.write("local")
+            with open(join(REMOTE_PATH, str(d), str(sub), "stale"), 'w') as fd:
+                fd.write("stale")
+
+    with mock.patch('paramiko.SFTPClient.from_transport', side_effect=paramiko.SFTPClient.from_transport) as open_:
+        _sync(scan_channels=6, channels=1)
+    # the first session, and the other scanning ones
+    eq_(open_.call_count, 6)
+
+    # the server doesn't allow more sessions
+    with open(join(LOCAL_FOLDER, "0", "0", "new"), 'w') as fd:
+        fd.write("new")
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        scan_channels=6,
+    )
+    with mock.patch('paramiko.SFTPClient.from_transport', side_effect=paramiko.SSHException("no more sessions")):
+        plan = sync.scan()
+    sync.close()
+    eq_([(a.kind, a.path) for a in plan if a.kind != "setstat"], [("upload", join("0", "0", "new"))])
+
+
+@with_setup(setup_test, teardown_test)
+def test_local_scanner():
+    """Test listing local directories ahead of the comparison."""
+    for d in range(10):
+        for sub in range(5):
+            os.makedirs(join(LOCAL_FOLDER, str(d), str(sub)))
+            with open(join(LOCAL_FOLDER, str(d), str(sub), "file"), 'w') as fd:
+                fd.write(str(d * sub))
+    os.symlink("0", join(LOCAL_FOLDER, "link"))
+
+    listed = []
+
+    def list_directory(relative_path):
+        listed.append(relative_path)
+        if relative_path == join("9", "4"):
+            raise OSError(13, "Permission denied")
+        return dict(
+            (f, os.lstat(join(LOCAL_FOLDER, relative_path, f)))
+            for f in os.listdir(join(LOCAL_FOLDER, relative_path))
+        )
+
+    scanner = LocalScanner(list_directory, lambda path: path == "8", 4)
+    scanner.add("")
+    time.sleep(0.5)
+    # excluded directories, and symlinks, are never listed
+    eq_(len(listed), 1 + 9 + 9 * 5)
+    assert set(scanner.take("")) == set(str(d) for d in range(10)) | {"link"}
+    eq_(set(scanner.take(join("0", "0"))), {"file"})
+    assert_raises(OSError, scanner.take, join("9", "4"))
+    assert scanner.take("8") is None
+    scanner.stop()
+
+    # it doesn't list too many directories ahead
+    del listed[:]
+    scanner = LocalScanner(list_directory, lambda path: False, 4, ahead=5)
+    scanner.add("")
+    time.sleep(0.2)
+    eq_(len(listed), 5)
+    scanner.take("")
+    time.sleep(0.2)
+    eq_(len(listed), 6)
+    # not listed yet: who needs it lists it, and it isn't listed again
+    assert scanner.take(join("9", "0")) is None
+    scanner.stop()
+
+    with open(join(LOCAL_FOLDER, "exclude"), 'w') as fd:
+        fd.write("/8\n")
+    with mock.patch('sftpclone.sftpclone.SFTPClone._local_entries', autospec=True,
+                    side_effect=SFTPClone._local_entries) as local_entries:
+        _sync(local_threads=8, exclude=join(LOCAL_FOLDER, "exclude"))
+    eq_(local_entries.call_count, 1 + 9 + 9 * 5)
+    for d in (0, 9):
+        with open(join(REMOTE_PATH, str(d), "4", "file")) as fd:
+            eq_(fd.read(), str(d * 4))
+    assert not os.path.exists(join(REMOTE_PATH, "8"))
+
+
 @with_setup(None, teardown_test)
 def test_create_remote_directory():
     """Test create a remote folder."""
@@ -739,3 +1515,713 @@ def test_create_remote_directory():
         '-r'])
 
     assert(os.listdir(REMOTE_PATH) == os.listdir(LOCAL_FOLDER))
+
+
+@with_setup(setup_test, teardown_test)
+def test_streamed_listing():
+    """Test comparing a huge remote directory while it's being listed."""
+    for i in range(600):
+        with open(join(LOCAL_FOLDER, "f{}".format(i)), 'w') as fd:
+            fd.write("local")
+        if i % 2:
+            copy(join(LOCAL_FOLDER, "f{}".format(i)), REMOTE_PATH)
+        if i % 3 == 0:
+            with open(join(REMOTE_PATH, "stale{}".format(i)), 'w') as fd:
+                fd.write("stale")
+        if i % 50 == 0:
+            # their destination is read in the middle of the listing
+            os.symlink("f{}".format(i), join(LOCAL_FOLDER, "link{}".format(i)))
+            os.symlink("stale", join(REMOTE_PATH, "link{}".format(i)))
+
+    with mock.patch.object(_SFTPClient, 'listdir_attr', side_effect=AssertionError("not streamed")), \
+            mock.patch.object(_SFTPClient, 'listdir_iter', autospec=True,
+                              side_effect=_SFTPClient.listdir_iter) as listdir_iter:
+        _sync(scan_channels=1, listing_requests=2)
+    eq_(listdir_iter.call_args[1], {"read_aheads": 2})
+    for i in range(0, 600, 50):
+        eq_(os.readlink(join(REMOTE_PATH, "link{}".format(i))), "f{}".format(i))
+
+
+@with_setup(setup_test, teardown_test)
+def test_journal():
+    """Test resuming an interrupted sync from its journal, without scanning again."""
+    for d in range(3):
+        os.mkdir(join(LOCAL_FOLDER, str(d)))
+        for f in range(10):
+            with open(join(LOCAL_FOLDER, str(d), str(f)), 'w') as fd:
+                fd.write(str(d * f))
+    with open(join(REMOTE_PATH, "stale"), 'w') as fd:
+        fd.write("stale")
+    journal_path = join(REMOTE_ROOT, "journal")
+
+    uploads = []
+    file_upload = SFTPClone.file_upload
+
+    def interrupted_upload(self, *args, **kwargs):
+        if len(uploads) == 12:
+            raise paramiko.SSHException("connection lost")
+        uploads.append(args[0])
+        return file_upload(self, *args, **kwargs)
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        journal_path=journal_path,
+        channels=1,
+    )
+    with mock.patch.object(SFTPClone, 'file_upload', interrupted_upload):
+        assert_raises(paramiko.SSHException, sync.run)
+    sync.close()
+    assert os.path.exists(journal_path)
+    assert not os.path.exists(join(REMOTE_PATH, "stale"))
+
+    with mock.patch.object(SFTPClone, 'scan', side_effect=AssertionError("scanned again")), \
+            mock.patch.object(SFTPClone, 'file_upload', autospec=True, side_effect=file_upload) as upload:
+        _sync(journal_path=journal_path)
+    eq_(upload.call_count, 30 - 12)
+    assert not os.path.exists(journal_path)
+
+    # a sync with other options (here, another list of paths) doesn't resume it
+    for f in range(20):
+        with open(join(LOCAL_FOLDER, "new{}".format(f)), 'w') as fd:
+            fd.write(str(f))
+    del uploads[:]
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        journal_path=journal_path,
+        channels=1,
+    )
+    with mock.patch.object(SFTPClone, 'file_upload', interrupted_upload):
+        assert_raises(paramiko.SSHException, sync.run)
+    sync.close()
+    assert os.path.exists(journal_path)
+
+    paths = join(REMOTE_ROOT, "paths")
+    with open(paths, 'w') as fd:
+        fd.write("new9\n")
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        journal_path=journal_path,
+        files_from=paths,
+    )
+    sync.run()
+    sync.close()
+    os.remove(paths)
+    assert os.path.exists(join(REMOTE_PATH, "new9"))
+    assert not os.path.exists(join(REMOTE_PATH, "new5"))
+
+
+@with_setup(setup_test, teardown_test)
+def test_reconnect():
+    """Test going on with the sync once the lost connection is back."""
+    for d in range(4):
+        os.mkdir(join(LOCAL_FOLDER, str(d)))
+        for f in range(10):
+            with open(join(LOCAL_FOLDER, str(d), str(f)), 'w') as fd:
+                fd.write(str(d * f))
+        os.symlink(str(d), join(LOCAL_FOLDER, "link{}".format(d)))
+    for f in range(10):
+        with open(join(REMOTE_PATH, "stale{}".format(f)), 'w') as fd:
+            fd.write("stale")
+
+    calls = Counter()
+
+    def drop_connection(name, method):
+        # the connection is lost in the middle of the nth call
+        def wrapper(self, *args, **kwargs):
+            calls[name] += 1
+            if calls[name] == 5:
+                self.transport.close()
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        channels=1,
+        scan_channels=1,
+        listing_requests=1,
+    )
+    with mock.patch('sftpclone.sftpclone.RETRY_DELAY', 0), \
+            mock.patch.object(SFTPClone, '_plan_node', drop_connection("scan", SFTPClone._plan_node)), \
+            mock.patch.object(SFTPClone, 'file_upload', drop_connection("upload", SFTPClone.file_upload)):
+        sync.run()
+    sync.close()
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+    eq_(sync.stats["upload"], 40)
+    eq_(sync.stats["delete"], 10)
+
+    # or isn't back
+    with open(join(LOCAL_FOLDER, "new"), 'w') as fd:
+        fd.write("new")
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        retries=2,
+    )
+    calls.clear()
+    with mock.patch('sftpclone.sftpclone.RETRY_DELAY', 0), \
+            mock.patch.object(SFTPClone, 'file_upload', drop_connection("upload", SFTPClone.file_upload)), \
+            mock.patch.object(SFTPClone, '_open_transport', side_effect=socket.error("connection refused")) as open_:
+        calls["upload"] = 4
+        assert_raises(socket.error, sync.run)
+    eq_(open_.call_count, 2)
+
+    # or is lost after a request is performed, but before its reply
+    def lose_reply(name, method):
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            calls[name] += 1
+            if calls[name] == 2:
+                self.sock.get_transport().close()
+                raise paramiko.SSHException("Server connection dropped")
+            return result
+        return wrapper
+
+    rmtree(REMOTE_PATH)
+    os.mkdir(REMOTE_PATH)
+    calls.clear()
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+        channels=1,
+    )
+    with mock.patch('sftpclone.sftpclone.RETRY_DELAY', 0), \
+            mock.patch.object(_SFTPClient, 'mkdir', lose_reply("mkdir", _SFTPClient.mkdir)), \
+            mock.patch.object(SFTPClone, '_match_modes', drop_connection("modes", SFTPClone._match_modes)):
+        sync.run()
+    sync.close()
+    assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+    eq_(sync.stats["mkdir"], 4)
+    # the file being uploaded to a temporary name is removed once reconnected
+    assert not [f for _, _, files in os.walk(REMOTE_PATH) for f in files if f.endswith(".part")]
+
+
+@with_setup(setup_test, teardown_test)
+def test_sparse_files():
+    """Test uploading only the data of sparse files, leaving holes on the remote side."""
+    if not hasattr(os, "SEEK_DATA"):
+        raise SkipTest("holes can't be found (Python < 3.3)")
+    mib = 1024 * 1024
+    layouts = {
+        "image": (3 * mib, [(0, b"boot"), (2 * mib, b"data")]),  # and a trailing hole
+        "chunked": (40 * mib, [(mib, b"first"), (39 * mib, b"last")]),  # a chunk of nothing but a hole
+        "empty": (mib, []),
+    }
+    for name, (size, extents) in layouts.items():
+        with open(join(LOCAL_FOLDER, name), 'wb') as fd:
+            for offset, data in extents:
+                fd.seek(offset)
+                fd.write(data)
+            fd.truncate(size)
+
+    st = os.stat(join(LOCAL_FOLDER, "chunked"))
+    if st.st_blocks * 512 >= st.st_size:
+        raise SkipTest("the file system doesn't support holes")
+
+    with open(join(LOCAL_FOLDER, "image"), 'rb') as fd:
+        extents = data_extents(fd.fileno(), 0, 3 * mib)
+    eq_([(o // 4096, o + n >= 2 * mib) for o, n in extents], [(0, False), (2 * mib // 4096, True)])
+    with open(join(LOCAL_FOLDER, "empty"), 'rb') as fd:
+        eq_(data_extents(fd.fileno(), 0, mib), [])
+
+    with mock.patch.object(paramiko.SFTPFile, 'write', autospec=True, side_effect=paramiko.SFTPFile.write) as write:
+        _sync(chunked_size=32 * mib)
+    # only the blocks holding data
+    assert sum(len(c[0][1]) for c in write.call_args_list) <= 4 * 64 * 1024
+
+    for name, (size, _) in layouts.items():
+        remote_st = os.stat(join(REMOTE_PATH, name))
+        eq_(remote_st.st_size, size)
+        assert remote_st.st_blocks * 512 < mib
+        with open(join(LOCAL_FOLDER, name), 'rb') as lf, open(join(REMOTE_PATH, name), 'rb') as rf:
+            assert lf.read() == rf.read()
+
+
+@with_setup(setup_test, teardown_test)
+def test_capabilities():
+    """Test probing what the server can do, and using it."""
+    with open(join(LOCAL_FOLDER, "file"), 'wb') as fd:
+        fd.write(os.urandom(1024 * 1024))
+    os.link(join(LOCAL_FOLDER, "file"), join(LOCAL_FOLDER, "link"))
+
+    def write_lengths(**kwargs):
+        # the length of the write requests sent by a sync
+        lengths = []
+        async_request = paramiko.SFTPClient._async_request
+
+        def record(self, fileobj, t, *args):
+            if t == CMD_WRITE:
+                lengths.append(len(args[2]))
+            return async_request(self, fileobj, t, *args)
+
+        with mock.patch.object(paramiko.SFTPClient, '_async_request', record):
+            _sync(**kwargs)
+        return lengths
+
+    sync = SFTPClone(
+        LOCAL_FOLDER,
+        'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+        port=2222,
+        identity_files=[t_path("id_rsa")],
+    )
+    capabilities = sync.capabilities
+    assert not capabilities.exec_allowed
+    sync.close()
+    for extension in ("hardlink@openssh.com", "copy-data", "check-file", "limits@openssh.com",
+                      "posix-rename@openssh.com"):
+        assert capabilities.supports(extension)
+    assert not capabilities.supports("fsync@openssh.com")
+    eq_(capabilities.write_length, 255 * 1024)
+    # whole requests, the last one aside
+    eq_(Counter(write_lengths(hard_links=True)), {255 * 1024: 4, 4096: 1})
+    eq_(os.stat(join(REMOTE_PATH, "link")).st_nlink, 2)
+
+    # a bare server
+    rmtree(REMOTE_PATH)
+    os.mkdir(REMOTE_PATH)
+    with mock.patch.dict(StubSFTPSubsystem.extensions, clear=True):
+        sync = SFTPClone(
+            LOCAL_FOLDER,
+            'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+            port=2222,
+            identity_files=[t_path("id_rsa")],
+            hard_links=True,
+            dedupe=True,
+        )
+        eq_(sorted(sync.capabilities.extensions), ["check-file"])
+        eq_(sync.capabilities.write_length, 32768)
+        # nothing is planned that the server can't do
+        assert not sync.dedupe
+        eq_(sorted((a.kind, a.path) for a in sync.scan()), [("upload", "file"), ("upload", "link")])
+        sync.close()
+
+        eq_(Counter(write_lengths(hard_links=True)), {32768: 64})
+    eq_(os.stat(join(REMOTE_PATH, "link")).st_nlink, 1)
+
+    # exec is probed once, when needed, and an account forced to run an SFTP server doesn't fool it
+    for mode, allowed in (("shell", True), ("sftp", False)):
+        with mock.patch.object(StubServer, 'exec_mode', mode), mock.patch.object(StubServer, 'commands', []):
+            _sync()
+            eq_(StubServer.commands, [])
+            sync = SFTPClone(
+                LOCAL_FOLDER,
+                'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+                port=2222,
+                identity_files=[t_path("id_rsa")],
+            )
+            try:
+                eq_(sync.capabilities.exec_allowed, allowed)
+                eq_(sync.capabilities.exec_allowed, allowed)
+                eq_(len(StubServer.commands), 1)
+            finally:
+                sync.close()
+
+
+@with_setup(setup_test, teardown_test)
+def test_atomic_upload():
+    """Test that remote files are replaced at once, never seen half-written."""
+    mib = 1024 * 1024
+    for name, size in (("page.html", 1024), ("video", 40 * mib)):
+        with open(join(LOCAL_FOLDER, name), 'wb') as fd:
+            fd.write(os.urandom(size))
+        with open(join(REMOTE_PATH, name), 'wb') as fd:
+            fd.write(b"old")
+    # e.g. the same file in the previous release
+    os.link(join(REMOTE_PATH, "page.html"), join(REMOTE_PATH, "previous.html"))
+
+    def sync(**kwargs):
+        sync = SFTPClone(
+            LOCAL_FOLDER,
+            'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+            port=2222,
+            identity_files=[t_path("id_rsa")],
+            delete=False,
+            chunked_size=32 * mib,
+            **kwargs
+        )
+        try:
+            sync.run()
+        finally:
+            sync.close()
+
+    def remote_names():
+        return sorted(os.listdir(REMOTE_PATH))
+
+    def remote_content(name):
+        with open(join(REMOTE_PATH, name), 'rb') as fd:
+            return fd.read()
+
+    # uploads that fail leave nothing behind
+    with mock.patch.object(SFTPClone, '_send', side_effect=IOError("disk full")):
+        assert_raises(IOError, sync)
+    eq_(remote_names(), ["page.html", "previous.html", "video"])
+
+    seen = []
+    send = SFTPClone._send
+
+    def check_send(self, lf, rf, offset, length):
+        name = os.path.basename(lf.name)
+        seen.append((name, remote_content(name), remote_names()))
+        return send(self, lf, rf, offset, length)
+
+    with mock.patch.object(SFTPClone, '_send', check_send), \
+            mock.patch.object(paramiko.SFTPClient, 'chmod', side_effect=AssertionError("a request per attribute")):
+        sync()
+    eq_(sorted(name for name, _, _ in seen), ["page.html", "video", "video", "video"])
+    for name, content, names in seen:
+        eq_(content, b"old")
+        eq_(len([n for n in names if n.startswith("." + name + ".") and n.endswith(".part")]), 1)
+    eq_(remote_names(), ["page.html", "previous.html", "video"])
+    for name in ("page.html", "video"):
+        with open(join(LOCAL_FOLDER, name), 'rb') as fd:
+            assert remote_content(name) == fd.read()
+    eq_(remote_content("previous.html"), b"old")
+
+    # or written over, links included
+    with open(join(LOCAL_FOLDER, "page.html"), 'wb') as fd:
+        fd.write(b"new")
+    os.link(join(REMOTE_PATH, "page.html"), join(REMOTE_PATH, "other.html"))
+    sync(atomic=False)
+    eq_(remote_content("other.html"), b"new")
+
+    # the server failing to write some of the blocks
+    def write(self, offset, data):
+        if offset >= 64 * 1024:
+            return paramiko.SFTP_FAILURE
+        return paramiko.SFTPHandle.write(self, offset, data)
+
+    with open(join(LOCAL_FOLDER, "video"), 'r+b') as fd:
+        fd.write(b"new")
+    with mock.patch.object(StubSFTPHandle, 'write', write):
+        assert_raises(IOError, sync)
+        eq_(remote_names(), ["other.html", "page.html", "previous.html", "video"])
+        assert remote_content("video")[:3] != b"new"
+        assert_raises(IOError, sync, atomic=False)
+
+
+@with_setup(setup_test, teardown_test)
+def test_releases():
+    """Test the deployment of releases, seeded with the unchanged files of the current one."""
+    os.mkdir(join(LOCAL_FOLDER, "css"))
+    for name in ("index.html", "about.html", "logo.png", join("css", "site.css")):
+        with open(join(LOCAL_FOLDER, name), 'wb') as fd:
+            fd.write(os.urandom(1024))
+    os.symlink("index.html", join(LOCAL_FOLDER, "home.html"))
+
+    def deploy():
+        sync = SFTPClone(
+            LOCAL_FOLDER,
+            'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+            port=2222,
+            identity_files=[t_path("id_rsa")],
+            releases=2,
+        )
+        try:
+            sync.run()
+        finally:
+            sync.close()
+        return sync
+
+    def current():
+        return join(REMOTE_PATH, os.readlink(join(REMOTE_PATH, "current")))
+
+    def releases():
+        return sorted(os.listdir(join(REMOTE_PATH, "releases")))
+
+    def same_file(first, second, name):
+        return os.stat(join(first, name)).st_ino == os.stat(join(second, name)).st_ino
+
+    def content(path):
+        with open(path, 'rb') as fd:
+            return fd.read()
+
+    def check(release):
+        assert file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME] == file_tree(release)[os.path.basename(release)]
+        eq_(os.readlink(join(release, "home.html")), "index.html")
+        eq_(content(join(release, "index.html")), content(join(LOCAL_FOLDER, "index.html")))
+
+    # a real directory isn't replaced
+    os.mkdir(join(REMOTE_PATH, "current"))
+    assert_raises(SystemExit, deploy)
+    os.rmdir(join(REMOTE_PATH, "current"))
+
+    sync = deploy()
+    eq_((sync.stats["upload"], sync.stats["link"]), (4, 0))
+    first = current()
+    eq_(releases(), [os.path.basename(first)])
+    check(first)
+
+    old = content(join(first, "index.html"))
+    with open(join(LOCAL_FOLDER, "index.html"), 'wb') as fd:
+        fd.write(b"new")
+    os.remove(join(LOCAL_FOLDER, "about.html"))
+    os.chmod(join(LOCAL_FOLDER, "css", "site.css"), 0o600)  # it would change the linked one too
+
+    # the links are pipelined, with nothing to remove first
+    with mock.patch.object(paramiko.SFTPClient, 'remove', side_effect=AssertionError("removed")):
+        sync = deploy()
+    eq_((sync.stats["upload"], sync.stats["link"]), (2, 1))
+    second = current()
+    eq_(releases(), sorted(os.path.basename(r) for r in (first, second)))
+    check(second)
+    assert same_file(first, second, "logo.png")
+    assert not same_file(first, second, join("css", "site.css"))
+    # the previous release is left as it was
+    eq_(content(join(first, "index.html")), old)
+    assert os.path.exists(join(first, "about.html"))
+
+    # only the last ones are kept
+    with open(join(LOCAL_FOLDER, "logo.png"), 'wb') as fd:
+        fd.write(b"changed")
+    wait, link_release = _Replies.wait, SFTPClone._link_release
+    lost = []
+
+    def lose_reply(self, sftp, num):
+        # the first link is created, but the connection is lost before its reply
+        reply = wait(self, sftp, num)
+        if not lost:
+            lost.append(num)
+            sftp.sock.get_transport().close()
+            raise paramiko.SSHException("Server connection dropped")
+        return reply
+
+    def link_release_losing_reply(*args):
+        with mock.patch.object(_Replies, 'wait', lose_reply):
+            return link_release(*args)
+
+    with mock.patch('sftpclone.sftpclone.RETRY_DELAY', 0), \
+            mock.patch.object(SFTPClone, '_link_release', link_release_losing_reply):
+        sync = deploy()
+    assert lost
+    eq_((sync.stats["upload"], sync.stats["link"]), (1, 2))
+    third = current()
+    eq_(releases(), sorted(os.path.basename(r) for r in (second, third)))
+    check(third)
+    assert same_file(second, third, "index.html")
+
+    # without hard links, the unchanged files are copied
+    with mock.patch.dict(StubSFTPSubsystem.extensions):
+        del StubSFTPSubsystem.extensions["hardlink@openssh.com"]
+        sync = deploy()
+    eq_((sync.stats["upload"], sync.stats["link"], sync.stats["copy"]), (0, 0, 3))
+    fourth = current()
+    check(fourth)
+    assert not same_file(third, fourth, "index.html")
+
+
+@with_setup(setup_test, teardown_test)
+def test_git():
+    """Test syncing only the paths changed since the last deployed commit."""
+    def git(*args):
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(
+                ("git", "-c", "user.name=test", "-c", "user.email=test@example.com") + args,
+                cwd=LOCAL_FOLDER, stdout=devnull,
+            )
+
+    def write(name, content):
+        path = join(LOCAL_FOLDER, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fd:
+            fd.write(content)
+
+    def sync():
+        sync = SFTPClone(
+            LOCAL_FOLDER,
+            'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+            port=2222,
+            identity_files=[t_path("id_rsa")],
+            git=True,
+        )
+        try:
+            sync.run()
+        finally:
+            sync.close()
+        return sync
+
+    def check():
+        local = file_tree(LOCAL_FOLDER)[LOCAL_FOLDER_NAME]
+        remote = file_tree(REMOTE_PATH)[REMOTE_FOLDER]
+        del local[".git"]
+        del remote[".sftpclone-git.json"]
+        eq_(local, remote)
+        with open(join(REMOTE_PATH, ".sftpclone-git.json")) as fd:
+            return json.load(fd)
+
+    git("init", "-q")
+    write("index.html", b"index")
+    write(join("docs", "a.txt"), b"a" * 1024)
+    write(join("docs", "b.txt"), b"b")
+    write(join("old", "c.txt"), b"c")
+    write("ignored.log", b"log")
+    write(".gitignore", b"*.log\n")
+    git("add", "-A")
+    git("commit", "-q", "-m", "first")
+    os.remove(join(LOCAL_FOLDER, "ignored.log"))
+
+    # the first time, the whole tree is scanned
+    sync()
+    eq_(check()["dirty"], [])
+
+    write("index.html", b"new index")
+    git("mv", join("docs", "a.txt"), join("docs", "moved.txt"))
+    git("rm", "-q", join("old", "c.txt"))
+    git("commit", "-q", "-a", "-m", "second")
+    write("draft.html", b"untracked")
+    write(join("docs", "b.txt"), b"uncommitted")
+    write("ignored.log", b"ignored")
+    head = subprocess.check_output(("git", "rev-parse", "HEAD"), cwd=LOCAL_FOLDER).decode("ascii").strip()
+
+    # then, only the changed paths are checked
+    with mock.patch.object(SFTPClone, 'scan', side_effect=AssertionError("scanned")):
+        s = sync()
+    eq_((s.stats["upload"], s.stats["delete"]), (4, 2))
+    os.remove(join(LOCAL_FOLDER, "ignored.log"))
+    eq_(check(), {"commit": head, "dirty": [join("docs", "b.txt"), "draft.html"]})
+
+    # what was uncommitted is synced again
+    os.remove(join(LOCAL_FOLDER, "draft.html"))
+    git("checkout", "-q", "--", join("docs", "b.txt"))
+    with mock.patch.object(SFTPClone, 'scan', side_effect=AssertionError("scanned")):
+        s = sync()
+    eq_((s.stats["upload"], s.stats["delete"]), (1, 1))
+    eq_(check(), {"commit": head, "dirty": []})
+    with open(join(REMOTE_PATH, "docs", "b.txt"), 'rb') as fd:
+        eq_(fd.read(), b"b")
+
+
+@with_setup(setup_test, teardown_test)
+def test_files_from():
+    """Test syncing only a list of paths, without listing any directory."""
+    for name in (join("a", "b", "new.txt"), join("a", "other.txt"), "top.txt"):
+        path = join(LOCAL_FOLDER, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fd:
+            fd.write(name.encode("utf-8"))
+    os.mkdir(join(REMOTE_PATH, "a"))
+    os.mkdir(join(REMOTE_PATH, "unrelated"))
+    for name in ("gone.txt", join("unrelated", "keep.txt")):
+        with open(join(REMOTE_PATH, name), 'wb') as fd:
+            fd.write(b"remote")
+
+    def sync(files_from):
+        sync = SFTPClone(
+            LOCAL_FOLDER,
+            'test@127.0.0.1:' + '/' + REMOTE_FOLDER,
+            port=2222,
+            identity_files=[t_path("id_rsa")],
+            files_from=files_from,
+        )
+        try:
+            with mock.patch.object(_SFTPClient, 'listdir_iter', side_effect=AssertionError("listed")), \
+                    mock.patch.object(_SFTPClient, 'listdir_attr', side_effect=AssertionError("listed")):
+                sync.run()
+        finally:
+            sync.close()
+        return sync
+
+    list_path = t_path("files_from.txt")
+    try:
+        with open(list_path, 'wb') as fd:
+            fd.write(b"./a/b/new.txt\0/gone.txt\0a/b/new.txt\0")
+        s = sync(list_path)
+        eq_((s.stats["upload"], s.stats["mkdir"], s.stats["delete"]), (1, 1, 1))
+        eq_(sorted(os.listdir(REMOTE_PATH)), ["a", "unrelated"])
+        eq_(os.listdir(join(REMOTE_PATH, "a")), ["b"])
+        eq_(os.listdir(join(REMOTE_PATH, "unrelated")), ["keep.txt"])
+        with open(join(REMOTE_PATH, "a", "b", "new.txt"), 'rb') as fd:
+            eq_(fd.read(), join("a", "b", "new.txt").encode("utf-8"))
+
+        # one per line, from the standard input
+        with mock.patch.object(sys, 'stdin', io.StringIO("top.txt\r\n\na/other.txt\n")):
+            s = sync("-")
+        eq_(s.stats["upload"], 2)
+        eq_(sorted(os.listdir(join(REMOTE_PATH, "a"))), ["b", "other.txt"])
+        assert os.path.exists(join(REMOTE_PATH, "top.txt"))
+
+        # but nothing outside of the local folder
+        with open(list_path, 'wb') as fd:
+            fd.write(b"a/../../secret\n")
+        assert_raises(SystemExit, sync, list_path)
+    finally:
+        os.remove(list_path)
+
+
+@with_setup(setup_test, teardown_test)
+def test_undecodable_names():
+    """Test syncing file names which aren't valid UTF-8, as they are on disk."""
+    eq_(printable(b"\xffcaf\xe9 na\xc3\xafve\xc3"), "\\xffcaf\\xe9 na\u00efve\\xc3")
+
+    # their paths are bytes all along: on Python 2.x, they can't be joined with text ones
+    local, remote = fsencode(LOCAL_FOLDER), fsencode(REMOTE_PATH)
+
+    def sync(**kwargs):
+        SFTPClone(LOCAL_FOLDER, 'test@127.0.0.1:' + '/' + REMOTE_FOLDER, port=2222,
+                  identity_files=[t_path("id_rsa")], **kwargs).run()
+
+    try:
+        os.mkdir(join(local, b"dir\xff"))
+        for name in (b"caf\xe9.txt", join(b"dir\xff", b"inside\xfe"), "naïve.txt".encode("utf-8")):
+            with open(join(local, name), 'wb') as fd:
+                fd.write(name)
+        os.symlink(b"caf\xe9.txt", join(local, b"link\xe9"))
+        with open(join(remote, b"stale\xfe"), 'wb') as fd:
+            fd.write(b"stale")
+
+        sync()
+        if paramiko.py3compat.PY2:
+            # they can't be decoded, so they're skipped on both sides
+            eq_(sorted(os.listdir(remote)), sorted([b"stale\xfe", "naïve.txt".encode("utf-8")]))
+            return
+        eq_(sorted(os.listdir(remote)), sorted([b"caf\xe9.txt", b"dir\xff", "naïve.txt".encode("utf-8"), b"link\xe9"]))
+        eq_(os.listdir(join(remote, b"dir\xff")), [b"inside\xfe"])
+        with open(join(remote, b"dir\xff", b"inside\xfe"), 'rb') as fd:
+            eq_(fd.read(), join(b"dir\xff", b"inside\xfe"))
+        eq_(os.readlink(join(remote, b"link\xe9")), b"caf\xe9.txt")
+
+        # their remote names match the local ones
+        with mock.patch.object(SFTPClone, 'file_upload', side_effect=AssertionError("uploaded again")), \
+                mock.patch.object(SFTPClone, 'create_update_symlink', side_effect=AssertionError("linked again")):
+            sync()
+
+        os.remove(join(remote, b"caf\xe9.txt"))
+        with capture_sys_output() as (out, err):
+            sync(dry_run=True)
+        assert "upload   caf\\xe9.txt (8 bytes)" in out.getvalue()
+    finally:
+        # teardown_test can't remove them, on Python 2.x
+        rmtree(local, ignore_errors=True)
+        rmtree(remote, ignore_errors=True)
+
+
+def test_compact_stat():
+    """Test that plans keep compact records of the attributes, sharing the repeated values."""
+    st = os.lstat(t_path("id_rsa"))
+    action = Action("upload", "id_rsa", st.st_size, st, None)
+    assert type(action.st) is Stat
+    assert not hasattr(action.st, "__dict__")
+    for k in Stat.__slots__:
+        eq_(getattr(action.st, k), getattr(st, k))
+    assert Action(*action).st is action.st
+
+    attr = paramiko.SFTPAttributes.from_stat(st)
+    attr.st_mode = int(str(st.st_mode))  # an equal value, but another object
+    assert attr.st_mode is not action.st.st_mode
+    assert Action("delete", "id_rsa", 0, attr, None).st.st_mode is action.st.st_mode
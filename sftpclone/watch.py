@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Watch a local directory tree for changes."""
+
+# Python 2.7 backward compatibility
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from stat import S_ISDIR
+
+from sftpclone.compat import fsencode, fsdecode
+
+# from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | \
+    IN_ONLYDIR | IN_DONT_FOLLOW
+
+_EVENT = struct.Struct(str("iIII"))  # wd, mask, cookie, len
+
+
+def _libc():
+    """Return the C library if it provides inotify, None otherwise."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher(object):
+
+    """Report the paths changed inside a directory tree, using Linux inotify.
+
+    inotify isn't recursive, so every directory of the tree gets its own watch."""
+
+    def __init__(self, root):
+        """Watch the whole tree rooted at root."""
+        self.root = root
+        self._libc = _libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        self._paths = {}  # watch descriptor -> relative path
+        self._add_tree("")
+
+    def _add_tree(self, relative_path):
+        """Watch relative_path and all the directories below it."""
+        path = os.path.join(self.root, relative_path)
+        for dir_path, dirs, _ in os.walk(path):
+            wd = self._libc.inotify_add_watch(self._fd, fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                # it has been removed (or replaced) in the meantime
+                dirs[:] = []
+                continue
+            self._paths[wd] = os.path.relpath(dir_path, self.root) if dir_path != self.root else ""
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for some events and return the changed paths.
+
+        The result maps each relative path to True when its whole subtree has to be synced.
+        The root path ("") is returned if events have been lost."""
+        changes = {}
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return changes
+
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changes
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changes[""] = True
+                continue
+
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+
+            parent = self._paths.get(wd)
+            if parent is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue  # reported by its parent
+
+            name = fsdecode(name)
+            if isinstance(name, bytes):  # Python 2.x, it can't be decoded: the sync skips it too
+                continue
+            relative_path = os.path.join(parent, name)
+
+            # new directories are watched, and uploaded, as a whole
+            recursive = bool(mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO))
+            if recursive:
+                self._add_tree(relative_path)
+            changes[relative_path] = changes.get(relative_path, False) or recursive
+
+        return changes
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+
+    """Report the paths changed inside a directory tree, by periodically scanning it."""
+
+    def __init__(self, root, interval=1.0):
+        """Watch the whole tree rooted at root, scanning it every interval seconds."""
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._last = time.time()
+
+    def _scan(self):
+        snapshot = {}
+        for dir_path, dirs, files in os.walk(self.root):
+            for name in dirs + files:
+                path = os.path.join(dir_path, name)
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                snapshot[os.path.relpath(path, self.root)] = \
+                    (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+        return snapshot
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds and return the changed paths (see `InotifyWatcher.read`)."""
+        wait = self._last + self.interval - time.time()
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            time.sleep(wait)
+        if time.time() < self._last + self.interval:
+            return {}
+
+        snapshot, self._last = self._scan(), time.time()
+        changes = {
+            path: S_ISDIR(st[0]) and path not in self._snapshot
+            for path, st in snapshot.items()
+            if self._snapshot.get(path) != st
+        }
+        changes.update(
+            (path, False) for path in self._snapshot if path not in snapshot
+        )
+        self._snapshot = snapshot
+        return changes
+
+    def close(self):
+        pass
+
+
+def create_watcher(root, logger=None):
+    """Return an inotify watcher for root, falling back to polling where it isn't available."""
+    try:
+        return InotifyWatcher(root)
+    except OSError as e:
+        if logger:
+            logger.warning("Can't use inotify ({}), polling for changes instead.".format(e))
+        return PollingWatcher(root)
+
+
+def watch_changes(watcher, debounce=0.2, latency=1.0, timeout=1.0):
+    """Yield batches of changes from watcher, merging bursts of events.
+
+    A batch is yielded after debounce seconds without new events,
+    but no later than latency seconds after its first event.
+    Empty batches are yielded every timeout seconds while nothing happens."""
+    while True:
+        changes = watcher.read(timeout)
+        if not changes:
+            yield changes
+            continue
+
+        deadline = time.time() + latency
+        while True:
+            wait = min(debounce, deadline - time.time())
+            if wait <= 0:
+                break
+            more = watcher.read(wait)
+            if not more:
+                break
+            for path, recursive in more.items():
+                changes[path] = changes.get(path, False) or recursive
+
+        yield changes